@@ -2,11 +2,12 @@
 
 from traffix import *
 
-def template_2input_1sink():
+def template_2input_1sink(**map_kwargs):
     """
     Returns a simple model for 2 inputs, one with 2 paths to the sink point, one with just one path to the sink point.
+    Keyword arguments (e.g. flow_constant, seg_len) are passed to Map.
     """
-    m = Map(confirmation_messages = False)
+    m = Map(**{'confirmation_messages': False, **map_kwargs})
     m.add_inter(1, (0,0))
     m.add_inter(2, (1,0))
     m.add_inter(3, (0,1))
@@ -22,13 +23,14 @@ def template_2input_1sink():
     m.simulation_check_compile()
     return m
 
-def template_bridge(num_bridge_lanes = 1, speed_limit=50):
+def template_bridge(num_bridge_lanes = 1, speed_limit=50, **map_kwargs):
     """
     Returns a simple bridge model, allowing for variation in the number of lanes on the bridge.
+    Keyword arguments (e.g. flow_constant, seg_len) are passed to Map.
     """
     assert num_bridge_lanes >= 1, "num_bridge_lanes must be greater than 1"
     assert type(num_bridge_lanes) == int, "Please enter an integer"
-    m = Map(green_lights_per_time = 5, confirmation_messages = False)
+    m = Map(**{'green_lights_per_time': 5, 'confirmation_messages': False, **map_kwargs})
     m.add_inter(1, (0,2))
     m.add_inter(2, (0,1))
     m.add_inter(3, (0,0))
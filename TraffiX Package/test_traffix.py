@@ -0,0 +1,81 @@
+import numpy as np
+import pytest
+
+from playkit import template_bridge
+from traffix import Map
+
+
+def grid_model(size=3):
+    """
+    size x size grid with (i, j) labels, roads going right and down, and one inflow at (0, 0).
+    """
+    model = Map(seed=0)
+    for i in range(size):
+        for j in range(size):
+            model.add_inter((i, j), (j, -i))
+    for i in range(size):
+        for j in range(size):
+            if j + 1 < size:
+                model.add_road((i, j), (i, j + 1), 50, 100, 1)
+            if i + 1 < size:
+                model.add_road((i, j), (i + 1, j), 50, 100, 1)
+    model.declare_inflow_node((0, 0), {(size - 1, size - 1): 20})
+    model.simulation_check_compile()
+    return model
+
+
+def test_save_load_tuple_labels_with_demand(tmp_path):
+    model = grid_model()
+    path = tmp_path / "grid.trfx"
+    model.save(str(path))
+    loaded = Map.load(str(path), seed=0)
+
+    assert loaded.node_labels == model.node_labels
+    assert loaded.inputs == [(0, 0)]
+    assert loaded.cars_to_sinks_dict == model.cars_to_sinks_dict
+    assert loaded.sinks == model.sinks
+    assert loaded.node_id((2, 2)) == model.node_id((2, 2))
+    np.testing.assert_array_equal(loaded.state.num_cars, model.state.num_cars)
+
+
+def test_save_load_numpy_labels(tmp_path):
+    model = Map(seed=0)
+    ids = np.array([101, 102, 103], dtype=np.int64)
+    model.add_inters_from(ids, [(0, 0), (1, 0), (2, 0)])
+    model.add_roads_from({'start': ids[:-1], 'end': ids[1:], 'length': [100, 100], 'lanes': [1, 1]})
+    model.declare_inflow_node(ids[0], {ids[-1]: 10})
+    model.simulation_check_compile()
+    path = tmp_path / "osm.trfx"
+    model.save(str(path))
+    loaded = Map.load(str(path), seed=0)
+
+    assert loaded.node_labels == [101, 102, 103, "_i1"]
+    assert loaded.cars_to_sinks_dict == {(101, 103): 10}
+    assert loaded.node_id(ids[1]) == model.node_id(ids[1])
+
+
+def test_save_after_edit_needs_compile(tmp_path):
+    model = template_bridge()
+    model.remove_road(7, 10)
+    path = tmp_path / "bridge.trfx"
+    with pytest.raises(AssertionError, match="simulation_check_compile"):
+        model.save(str(path))
+
+    model.simulation_check_compile()
+    model.save(str(path))
+    loaded = Map.load(str(path), seed=0)
+    assert loaded.network.road_labels == model.network.road_labels
+    assert loaded.network.num_roads == len(loaded.network.road_labels)
+
+
+def test_ensemble_replica_matches_reseeded_map():
+    model = template_bridge(seed=0)
+    ensemble = model.ensemble(replicas=4, seed=1)
+    ensemble.run(5)
+    for r in (0, 3):
+        replica = template_bridge()
+        replica.reseed(ensemble.replica_seeds[r])
+        for _ in range(5):
+            replica.update_time()
+        np.testing.assert_allclose(ensemble.num_cars[r], replica.state.num_cars)
+        np.testing.assert_allclose(ensemble.terminations[r], replica.state.terminations)
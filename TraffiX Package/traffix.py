@@ -1,12 +1,14 @@
+import json
 import networkx as nx
 import numpy as np
-import random
 import matplotlib.pyplot as plt
 import matplotlib.cm as cm
 from matplotlib.animation import FuncAnimation
 from IPython.display import HTML
 import networkx as nx
+import scipy.sparse as sp
 from tqdm import tqdm
+from traffixengine import ActiveSet, CompiledNetwork, Ensemble, InflowSchedule, SimulationState, grouped_edge_flows, load_arrays, save_arrays, step_active, step_batched, step_sequential, step_synchronous
 
 def weighting(data):
     """
@@ -29,6 +31,21 @@ def add_dicts(dict1, dict2):
         result[key] = result.get(key, 0) + value
     return result
 
+def as_label(value):
+    """
+    Turns a node label read back from JSON into the label it was saved from: JSON writes tuples (e.g. (i, j) grid
+    labels) as lists, which are turned back into tuples.
+    """
+    return tuple(as_label(item) for item in value) if isinstance(value, list) else value
+
+def plain_label(value):
+    """
+    Turns NumPy scalars in a node label (e.g. np.int64 OSM ids from pandas) into the Python values JSON writes them as.
+    """
+    if isinstance(value, tuple):
+        return tuple(plain_label(item) for item in value)
+    return value.item() if isinstance(value, np.generic) else value
+
 class Map:
     """
     Road network class.
@@ -41,7 +58,12 @@ class Map:
                  confirmation_messages = True, 
                  seg_len = 20, 
                  dt=1, 
-                 flow_constant = 5): # should we add flow hesitancy/intertia
+                 flow_constant = 5, # should we add flow hesitancy/intertia
+                 update_mode = "sequential",
+                 seed = None,
+                 cell_budget = None,
+                 min_cells_per_road = 1,
+                 max_cells_per_road = None):
         """
         Parameters:
         capacity_per_length_per_lane: specifies how capacity for each road segment should be calculated. This constant is multiplied by lanes and length.
@@ -50,22 +72,49 @@ class Map:
         by speed_factor (see below).
         confirmation_messages: default to True, allows messages when calling add_road, add_inter, simulation_check_compile, etc.
         seg_len: specifies the length each road initialization should be split up by into segments.
+        update_mode: "sequential" (default) gives green lights one edge at a time in random order, each send updating
+        the state right away. "synchronous" computes every send from the same state and applies them all at once
+        (vectorized, for large networks and long horizons). "batched" keeps the sequential semantics but gives green
+        lights to independent batches of edges (same topological level, distinct downstream intersections) at once.
+        "active" only gives green lights to edges with cars and room downstream (for sparse traffic), with random
+        priorities that keep the dynamics of "sequential" in distribution (see traffixengine.step_active).
+        seed: seed of the NumPy Generator (self.rng) drawing the green light orders, for reproducible runs.
+        cell_budget, min_cells_per_road, max_cells_per_road: adaptive segmentation policy. If any is set, roads keep their
+        exact length and simulation_check_compile chooses the number of segments of each road with .segment_roads, for
+        about cell_budget cells in total (or seg_len long cells without a budget), within the per-road bounds.
         
-        G: the graph.
-        node_positions: the positions of the nodes when visualizing with matplotlib.
+        G: the graph. Its nodes are dense integer ids assigned by add_inter, see node_labels/node_ids for the labels.
+        node_labels: the label of each node id. node_ids: the id of each label.
+        node_positions: the positions of the nodes when visualizing with matplotlib, indexed by node id.
         num_lanes: the total number of lanes in the network.
         total_length_of_road: the total length of road used in the network.
         inputs: the nodes declared as inputs with .declare_inflow_node.
         cars_to_sinks_dict: the initial traffic count in the simulation, and the destination sink points for all cars.
+        edge_flows: the expected cars travelling each road ((u, v) ids), computed by simulation_check_compile.
+        flow_cache: what update_edge_flows needs to only recompute what changed since the last compile.
+        reach_index: the sinks reachable from each node, see .reachability_index.
+        schedules: the demand schedule of each input node with one (input node id -> (schedule, bin_steps)), see
+        .declare_inflow_node. schedule: the InflowSchedule compile_network builds from them.
         """
         self.G = nx.DiGraph()
-        self.node_positions = {}
+        self.node_labels = []
+        self.node_ids = {}
+        self.node_positions = []
         self.capacityPLPL = capacity_per_length_per_lane
         self.idealSPLPG = ideal_send_per_lane_per_green
         self.GLPT = green_lights_per_time
         self.seg_len = seg_len
         self.dt = dt
         self.flow_constant = flow_constant
+        assert update_mode in ("sequential", "synchronous", "batched", "active"), "update_mode must be 'sequential', 'synchronous', 'batched' or 'active'."
+        self.update_mode = update_mode
+        self.cell_budget = cell_budget
+        self.min_cells_per_road = min_cells_per_road
+        self.max_cells_per_road = max_cells_per_road
+        self.adaptive_segmentation = cell_budget is not None or min_cells_per_road != 1 or max_cells_per_road is not None
+        self.reseed(seed)
+        self.green_light_log = None
+        self.green_light_replay = None
         
         self.confirmation = confirmation_messages
         if self.confirmation:
@@ -81,6 +130,11 @@ class Map:
         self.inputs = []
         self.input_temp_nodes = []
         self.cars_to_sinks_dict = {}
+        self.edge_flows = {}
+        self.flow_cache = None
+        self.reach_index = None
+        self.schedules = {}
+        self.schedule = None
         
         
     def add_inter(self, label, pos):
@@ -88,36 +142,55 @@ class Map:
         Adds an intersection and assigns it a label and a position (tuple)
         """
         # label can be int or str
-        self.G.add_node(label)
-        self.node_positions[label] = pos
+        self.intern_node(label, pos)
         if self.confirmation:
             print(f"Intersection {label} added.")
         
+    def intern_node(self, label, pos):
+        """
+        Returns the integer node id of label, registering it (and its graph node) with a new dense id if it is new.
+        Updates the position of the node.
+        """
+        node = self.node_ids.get(label)
+        if node is None:
+            node = len(self.node_labels)
+            self.node_ids[label] = node
+            self.node_labels.append(label)
+            self.node_positions.append(pos)
+            self.G.add_node(node, label=label)
+            self.reach_index = None
+        else:
+            self.node_positions[node] = pos
+        return node
+    
+    def node_id(self, label):
+        """
+        Returns the integer node id (graph node) of an intersection label.
+        """
+        return self.node_ids[label]
+    
+    def node_label(self, node):
+        """
+        Returns the intersection label of an integer node id (graph node).
+        """
+        return self.node_labels[node]
+        
     def add_road(self, start, end, speed_limit, length, lanes, num_cars = 0):
         """
-        Adds a road from node labels.
+        Adds a road from node labels. The road is a single graph edge, split into num_segs segments of length seg_len
+        that only exist as cells of the compiled arrays (see compile_network). num_cars is the initial number of cars
+        on each segment. With adaptive segmentation, the road keeps its exact length (split in num_segs equal segments).
         """
         try:
-            start_pos = self.node_positions[start]
-            end_pos = self.node_positions[end]
-            pos = start_pos
-            direction = np.subtract(end_pos, start_pos)
+            u, v = self.node_ids[start], self.node_ids[end]
             # we round the road length according to the seg_len
-            num_segs = round(length / self.seg_len)
-
-            # intermediate intersection positions are purely for visualization purposes
-            last_inter = start
-            for i in range(num_segs-1):
-                pos += direction/num_segs
-                next_inter = "(" + str(start) + "," + str(end) + ")" + " S" + str(i) # (u,v) S0
-                self.add_inter(next_inter, tuple(pos)) 
-                
-                self.G.add_edge(last_inter, next_inter, capacity=self.capacityPLPL*self.seg_len*lanes, speed_limit=speed_limit, length=self.seg_len, lanes=lanes, num_cars=num_cars)
-                last_inter = next_inter
-                
-            
-            self.G.add_edge(last_inter, end, capacity=self.capacityPLPL*self.seg_len*lanes, speed_limit=speed_limit, length=self.seg_len, lanes=lanes, num_cars=num_cars)
-            self.total_length_of_road += lanes*length
+            num_segs = max(round(length / self.seg_len), 1)
+            seg_length = length / num_segs if self.adaptive_segmentation else self.seg_len
+            self.G.add_edge(u, v, capacity=self.capacityPLPL*seg_length*lanes, speed_limit=speed_limit, length=num_segs*seg_length,
+                            seg_length=seg_length, num_segs=num_segs, lanes=lanes, num_cars=num_cars*num_segs)
+            self.reach_index = None
+            self.mark_roads_changed([(u, v)])
+            self.total_length_of_road += lanes*num_segs*seg_length
             self.num_lanes += lanes
 
             if self.confirmation:
@@ -127,12 +200,74 @@ class Map:
             print("Nodes do not exist.")
             
         
+    def add_inters_from(self, labels, positions):
+        """
+        Adds many intersections at once. labels is a sequence of labels (list, NumPy array or pandas Series) and
+        positions the matching sequence of (x, y) positions (e.g. an N x 2 array).
+        """
+        labels = list(labels)
+        positions = [tuple(pos) for pos in np.asarray(positions, dtype=float).reshape(len(labels), 2).tolist()]
+        new_nodes = []
+        for label, pos in zip(labels, positions):
+            node = self.node_ids.get(label)
+            if node is None:
+                node = len(self.node_labels)
+                self.node_ids[label] = node
+                self.node_labels.append(label)
+                self.node_positions.append(pos)
+                new_nodes.append((node, {'label': label}))
+            else:
+                self.node_positions[node] = pos
+        self.G.add_nodes_from(new_nodes)
+        self.reach_index = None
+        if self.confirmation:
+            print(f"{len(labels)} intersections added.")
+    
+    def add_roads_from(self, table):
+        """
+        Adds many roads at once from columnar input: a pandas DataFrame or a dict of arrays with columns
+        start, end, length, lanes and optionally speed_limit (default 50) and num_cars (default 0), with the same
+        meaning as the add_road arguments. Rows whose start or end intersection does not exist are skipped.
+        """
+        starts = list(table['start'])
+        ends = list(table['end'])
+        num_roads = len(starts)
+        u = np.fromiter((self.node_ids.get(label, -1) for label in starts), dtype=np.int64, count=num_roads)
+        v = np.fromiter((self.node_ids.get(label, -1) for label in ends), dtype=np.int64, count=num_roads)
+        length = np.asarray(table['length'], dtype=float)
+        lanes = np.asarray(table['lanes'])
+        speed_limit = np.broadcast_to(np.asarray(table['speed_limit']) if 'speed_limit' in table else 50, (num_roads,))
+        num_cars = np.broadcast_to(np.asarray(table['num_cars'], dtype=float) if 'num_cars' in table else 0.0, (num_roads,))
+
+        # validate all endpoints at once
+        valid = (u >= 0) & (v >= 0)
+        if not valid.all():
+            missing = [(starts[i], ends[i]) for i in np.flatnonzero(~valid)]
+            print(f"Nodes do not exist, {len(missing)} roads skipped: {missing[:10]}")
+
+        # we round the road lengths according to the seg_len
+        num_segs = np.maximum(np.rint(length / self.seg_len), 1).astype(np.int64)
+        seg_length = length / num_segs if self.adaptive_segmentation else np.full(num_roads, float(self.seg_len))
+        capacity = self.capacityPLPL * seg_length * lanes
+        columns = zip(u[valid].tolist(), v[valid].tolist(), capacity[valid].tolist(), speed_limit[valid].tolist(),
+                      num_segs[valid].tolist(), seg_length[valid].tolist(), lanes[valid].tolist(), (num_cars * num_segs)[valid].tolist())
+        self.G.add_edges_from(
+            (a, b, {'capacity': cap, 'speed_limit': speed, 'length': segs * seg, 'seg_length': seg,
+                    'num_segs': segs, 'lanes': lane, 'num_cars': cars})
+            for a, b, cap, speed, segs, seg, lane, cars in columns)
+        self.reach_index = None
+        self.mark_roads_changed(zip(u[valid].tolist(), v[valid].tolist()))
+        self.total_length_of_road += (lanes * num_segs * seg_length)[valid].sum()
+        self.num_lanes += lanes[valid].sum()
+        if self.confirmation:
+            print(f"{int(valid.sum())} roads added.")
+        
     def get_summary(self):
         """
         Does not modify network. Returns summary statistics of the road network before or after compilation.
         """
         out_degrees = dict(self.G.out_degree(self.G.nodes))
-        sinks = [node for node in out_degrees if out_degrees[node] == 0]
+        sinks = [self.node_labels[node] for node in out_degrees if out_degrees[node] == 0]
         print(f"""
         Resources Used:
         - Total length of road used: {self.total_length_of_road} units
@@ -145,10 +280,28 @@ class Map:
             
     # Traffic initialization
     
-    def declare_inflow_node(self, source_node, initial_cars_to_sinks):
+    def declare_inflow_node(self, source_node, initial_cars_to_sinks, schedule = None, bin_steps = 1):
         """
         Takes an input node and assigns it some initial number of cars and their sink destinations.
+        The sinks must be reachable from the input node (checked with the reachability index, if the roads are acyclic).
+        schedule: makes the cars enter over time instead of all starting on the inflow road. Either an array of rates
+        (cars per unit of time) per bin of bin_steps time-steps, e.g. a rush-hour profile, or an iterator (e.g. a
+        generator) of rates, one per time-step, for very long horizons. The cars are added to the inflow road at the
+        start of each step. initial_cars_to_sinks still sets the turn probabilities: for an array, it is rescaled to the
+        schedule total (only its proportions matter), for an iterator, give the cars expected over the run.
         """
+        index = self.reachability_index()
+        if index is not None:
+            unreachable = self.unreachable_pairs([(source_node, sink) for sink in initial_cars_to_sinks])
+            assert not unreachable, f"Sinks not reachable from {source_node}: {[sink for source, sink in unreachable][:10]}"
+        if schedule is not None and hasattr(schedule, '__len__'):
+            schedule = np.asarray(schedule, dtype=float)
+            assert schedule.ndim == 1 and (schedule >= 0).all(), "A schedule array holds one nonnegative rate per bin."
+            assert sum(initial_cars_to_sinks.values()) > 0, "Give the proportions of the scheduled cars going to each sink."
+            scale = float(schedule.sum()) * bin_steps * self.dt / sum(initial_cars_to_sinks.values())
+            initial_cars_to_sinks = {sink: initial_cars_to_sinks[sink] * scale for sink in initial_cars_to_sinks}
+        elif schedule is not None:
+            schedule = iter(schedule)
         mod_initial_cars_to_sinks = {(source_node, sink): initial_cars_to_sinks[sink] for sink in initial_cars_to_sinks}
         self.cars_to_sinks_dict = add_dicts(self.cars_to_sinks_dict, mod_initial_cars_to_sinks)
         initial_cars = 0
@@ -157,18 +310,102 @@ class Map:
         
         self.inputs.append(source_node)
         input_name = "_i" + str(len(self.inputs))
-        self.G.add_node(input_name)
-        self.input_temp_nodes.append(input_name)
-        self.node_positions[input_name] = (self.node_positions[source_node][0] - 0.1, self.node_positions[source_node][1])
-        self.add_road_segment(input_name, source_node, speed_limit=50, length=100, lanes=1, num_cars=initial_cars)
+        source_pos = self.node_positions[self.node_ids[source_node]]
+        self.input_temp_nodes.append(self.intern_node(input_name, (source_pos[0] - 0.1, source_pos[1])))
+        self.add_road_segment(input_name, source_node, speed_limit=50, length=100, lanes=1, num_cars=initial_cars if schedule is None else 0)
+        if schedule is not None:
+            self.schedules[self.input_temp_nodes[-1]] = (schedule, bin_steps)
+        if index is not None:
+            # the input node reaches what its source node reaches
+            index[1].append(index[1][self.node_ids[source_node]])
+            self.reach_index = index
         self.num_lanes -= 1
         self.total_length_of_road -= 100
         if self.confirmation:
             print("Inflow node declared.")
 
+    def set_demand(self, od_matrix, sources = None, sinks = None):
+        """
+        Sets the whole demand in one pass, replacing the demand (and schedules) declared before. od_matrix is either
+        - a long-format table: a pandas DataFrame or dict of arrays with columns source, sink and cars (repeated pairs add up),
+        - a source x sink matrix of cars: a dense 2D array, a scipy.sparse matrix, or a pandas DataFrame indexed by
+          source labels with sink labels as columns. sources and sinks give the labels of the rows and columns of arrays.
+        Each source gets one inflow road carrying the total of its row, like declare_inflow_node: sources with an inflow
+        road keep it (set to the new total), and the inflow roads of sources left out of the demand are emptied.
+        The sinks must be reachable from their sources (checked with the reachability index, if the roads are acyclic).
+        """
+        # flatten to one entry per pair
+        if isinstance(od_matrix, dict) or (hasattr(od_matrix, 'columns') and {'source', 'sink', 'cars'} <= set(od_matrix.columns)):
+            source_labels, sink_labels = list(od_matrix['source']), list(od_matrix['sink'])
+            cars = np.asarray(od_matrix['cars'], dtype=float)
+        else:
+            if sp.issparse(od_matrix):
+                coo = sp.coo_matrix(od_matrix)
+                rows, cols, cars = coo.row, coo.col, coo.data.astype(float)
+            else:
+                if hasattr(od_matrix, 'columns'):
+                    sources, sinks = list(od_matrix.index), list(od_matrix.columns)
+                dense = np.asarray(od_matrix, dtype=float)
+                rows, cols = np.nonzero(dense)
+                cars = dense[rows, cols]
+            assert sources is not None and sinks is not None, "Give the labels of the rows and columns of the matrix (sources and sinks)."
+            sources, sinks = list(sources), list(sinks)
+            source_labels = [sources[row] for row in rows.tolist()]
+            sink_labels = [sinks[col] for col in cols.tolist()]
+        
+        # validate all pairs at once
+        missing = [label for label in set(source_labels) | set(sink_labels) if label not in self.node_ids]
+        assert not missing, f"Nodes do not exist: {missing[:10]}"
+        index = self.reachability_index()
+        if index is not None:
+            unreachable = self.unreachable_pairs(zip(source_labels, sink_labels))
+            assert not unreachable, f"{len(unreachable)} (source, sink) pairs have a sink that is not reachable from the source: {unreachable[:10]}"
+        
+        cars_to_sinks = {}
+        for pair, pair_cars in zip(zip(source_labels, sink_labels), cars.tolist()):
+            if pair_cars:
+                cars_to_sinks[pair] = cars_to_sinks.get(pair, 0) + pair_cars
+        self.cars_to_sinks_dict = cars_to_sinks
+        self.schedules = {}
+        totals = {}
+        for (source_node, sink), pair_cars in cars_to_sinks.items():
+            totals[source_node] = totals.get(source_node, 0) + pair_cars
+        
+        # reuse the inflow road of each declared source, empty the rest
+        inflow_roads = {}
+        for source_node, temp_node in zip(self.inputs, self.input_temp_nodes):
+            self.G[temp_node][self.node_ids[source_node]]['num_cars'] = 0
+            inflow_roads.setdefault(source_node, temp_node)
+        for source_node, temp_node in inflow_roads.items():
+            if source_node in totals:
+                self.G[temp_node][self.node_ids[source_node]]['num_cars'] = totals[source_node]
+        
+        # and add the inflow roads of the new sources together
+        new_roads = []
+        for source_node in totals:
+            if source_node in inflow_roads:
+                continue
+            self.inputs.append(source_node)
+            source_pos = self.node_positions[self.node_ids[source_node]]
+            temp_node = self.intern_node("_i" + str(len(self.inputs)), (source_pos[0] - 0.1, source_pos[1]))
+            self.input_temp_nodes.append(temp_node)
+            new_roads.append((temp_node, self.node_ids[source_node],
+                              {'capacity': self.capacityPLPL*100, 'speed_limit': 50, 'length': 100, 'seg_length': 100,
+                               'num_segs': 1, 'lanes': 1, 'num_cars': totals[source_node]}))
+        self.G.add_edges_from(new_roads)
+        if index is not None:
+            # the input nodes reach what their source nodes reach
+            index[1].extend(index[1][source] for temp_node, source, data in new_roads)
+        self.reach_index = index
+        if self.confirmation:
+            print(f"Demand of {len(cars_to_sinks)} (source, sink) pairs set, {len(new_roads)} inflow nodes declared.")
+    
     def add_road_segment(self, start, end, speed_limit, length, lanes, num_cars = 0):
         try:
-            self.G.add_edge(start, end, capacity=self.capacityPLPL*length*lanes, speed_limit=speed_limit, length=length, lanes=lanes, num_cars=num_cars)
+            self.G.add_edge(self.node_ids[start], self.node_ids[end], capacity=self.capacityPLPL*length*lanes, speed_limit=speed_limit, length=length,
+                            seg_length=length, num_segs=1, lanes=lanes, num_cars=num_cars)
+            self.reach_index = None
+            self.mark_roads_changed([(self.node_ids[start], self.node_ids[end])])
             if self.confirmation:
                 print(f"Road with {lanes} lanes between {start} and {end} added.")
             self.num_lanes += lanes
@@ -176,63 +413,206 @@ class Map:
         except:
             print("Nodes do not exist.")
     
+    def edit_road(self, start, end, speed_limit = None, length = None, lanes = None):
+        """
+        Changes the speed limit, length and/or lanes of an existing road from node labels, keeping its cars. The
+        capacity and segments follow, and the next simulation_check_compile only recomputes the turn probabilities the
+        edit affects (changing lanes or speed limits does not change them at all).
+        """
+        data = self.G[self.node_ids[start]][self.node_ids[end]]
+        if speed_limit is not None:
+            data['speed_limit'] = speed_limit
+        if lanes is not None:
+            self.num_lanes += lanes - data['lanes']
+            self.total_length_of_road += (lanes - data['lanes']) * data['length']
+            data['lanes'] = lanes
+        if length is not None:
+            num_segs = max(round(length / self.seg_len), 1)
+            data['seg_length'] = length / num_segs if self.adaptive_segmentation else self.seg_len
+            data['num_segs'] = num_segs
+            self.total_length_of_road += data['lanes'] * (num_segs * data['seg_length'] - data['length'])
+            data['length'] = num_segs * data['seg_length']
+        data['capacity'] = self.capacityPLPL * data['seg_length'] * data['lanes']
+        if self.confirmation:
+            print(f"Road between {start} and {end} edited.")
+    
+    def remove_road(self, start, end):
+        """
+        Removes the road from start to end (node labels) and its turn probability.
+        """
+        u, v = self.node_ids[start], self.node_ids[end]
+        data = self.G[u][v]
+        self.num_lanes -= data['lanes']
+        self.total_length_of_road -= data['lanes'] * data['length']
+        self.G.remove_edge(u, v)
+        self.reach_index = None
+        self.mark_roads_changed([(u, v)])
+        self.G.nodes[u].pop((u, v), None)
+        if self.confirmation:
+            print(f"Road between {start} and {end} removed.")
+    
     # Check and Compilation for simulation
     
-    def simulation_check_compile(self):
+    def mark_roads_changed(self, roads):
+        """
+        Makes the next incremental simulation_check_compile recompute the flows and turn probabilities around roads
+        ((u, v) ids), as if their length had changed. Called when roads are added or removed, so a road removed and added
+        back with the same length still gets its turn probability.
+        """
+        if self.flow_cache is not None:
+            self.flow_cache['marked'].update(roads)
+    
+    def reachability_index(self):
+        """
+        Returns the reachability index of the graph, built once per graph (then kept until roads or intersections are
+        added or removed): a pair (sink_bits, reach) where sink_bits maps each sink (node id without out-going roads) to
+        its bit, and reach[node] is the bitset (Python int) of the sinks reachable from node id. Built in reverse
+        topological order, each node ORing the bitsets of its successors. Returns None if the roads have a cycle.
+        """
+        if self.reach_index is None:
+            try:
+                order = list(nx.topological_sort(self.G))
+            except nx.NetworkXUnfeasible:
+                return None
+            sink_bits = {}
+            for node in order:
+                if not self.G.succ[node]:
+                    sink_bits[node] = 1 << len(sink_bits)
+            reach = [0] * self.G.number_of_nodes()
+            for node in reversed(order):
+                bits = sink_bits.get(node, 0)
+                for child in self.G.succ[node]:
+                    bits |= reach[child]
+                reach[node] = bits
+            self.reach_index = (sink_bits, reach)
+        return self.reach_index
+    
+    def unreachable_pairs(self, pairs):
+        """
+        Returns the (source, sink) label pairs of pairs whose sink is not a sink (an intersection without out-going
+        roads) reachable from the source, using the reachability index. Labels that do not exist count as unreachable.
+        """
+        sink_bits, reach = self.reachability_index()
+        unreachable = []
+        for source_node, sink in pairs:
+            source_id, sink_id = self.node_ids.get(source_node), self.node_ids.get(sink)
+            if source_id is None or not reach[source_id] & sink_bits.get(sink_id, 0):
+                unreachable.append((source_node, sink))
+        return unreachable
+    
+    def live_roads(self, demand):
+        """
+        Returns the roads ((u, v) ids) that can carry flow for demand, a dict of (source id, sink id) pairs: the roads
+        on some path from a source to one of its sinks. A forward pass in topological order gives each node the bitset
+        of the sinks wanted by the sources reaching it, and road (u, v) is live if v reaches one of the sinks u wants.
+        """
+        sink_bits, reach = self.reachability_index()
+        wanted = [0] * self.G.number_of_nodes()
+        for (source, sink), cars in demand.items():
+            wanted[source] |= sink_bits.get(sink, 0)
+        for node in nx.topological_sort(self.G):
+            if wanted[node]:
+                for child in self.G.succ[node]:
+                    wanted[child] |= wanted[node]
+        return [(u, v) for u, v in self.G.edges if wanted[u] & reach[v]]
+    
+    
+    def segment_roads(self, cell_budget = None, min_cells = None, max_cells = None):
+        """
+        Chooses the number of segments (cells) of every road and returns the total number of cells the compiled network
+        will have. Defaults to the Map's segmentation policy (cell_budget, min_cells_per_road, max_cells_per_road).
+        All roads get about the same cell length, the smallest one giving at most cell_budget cells in total (seg_len
+        without a budget), so travel times are resolved evenly over the network. Each road gets between min_cells and
+        max_cells cells, but no cell shorter than flow_constant * dt: a shorter cell would empty in less than a
+        time-step and slow its cars down. Inflow roads keep their single segment, and the cars on each road are kept.
+        Called by simulation_check_compile with adaptive segmentation, call compile_network after calling it yourself.
+        """
+        cell_budget = self.cell_budget if cell_budget is None else cell_budget
+        min_cells = self.min_cells_per_road if min_cells is None else min_cells
+        max_cells = self.max_cells_per_road if max_cells is None else max_cells
+        input_temp_nodes = set(self.input_temp_nodes)
+        roads = [(u, v) for u, v in self.G.edges if u not in input_temp_nodes]
+        fixed_cells = self.G.number_of_edges() - len(roads)
+        if not roads:
+            return fixed_cells
+        length = np.array([self.G[u][v]['length'] for u, v in roads], dtype=float)
+        hi = np.maximum(np.floor(length / (self.flow_constant * self.dt)), 1)
+        if max_cells is not None:
+            hi = np.minimum(hi, max_cells)
+        lo = np.minimum(min_cells, hi)
+        cells = lambda cell_length: np.clip(np.rint(length / cell_length), lo, hi)
+        if cell_budget is None:
+            num_segs = cells(self.seg_len)
+        else:
+            budget = cell_budget - fixed_cells
+            assert lo.sum() <= budget, f"A cell budget of {cell_budget} is below the {int(lo.sum()) + fixed_cells} cells the roads need at least."
+            # the total is non-increasing in the cell length, bisect (in log space) for the finest one within budget
+            short, long = np.log(length.min() / (2 * hi.max())), np.log(2 * length.max())
+            for _ in range(60):
+                mid = (short + long) / 2
+                if cells(np.exp(mid)).sum() <= budget:
+                    long = mid
+                else:
+                    short = mid
+            num_segs = cells(np.exp(long))
+        num_segs = num_segs.astype(np.int64)
+        for (u, v), segs, road_length in zip(roads, num_segs.tolist(), length.tolist()):
+            data = self.G[u][v]
+            data['num_segs'] = segs
+            data['seg_length'] = road_length / segs
+            data['capacity'] = self.capacityPLPL * data['seg_length'] * data['lanes']
+        return int(num_segs.sum()) + fixed_cells
+    
+    def simulation_check_compile(self, incremental = True, processes = 1):
         """
         Checks if the road network is suitable for simulation
         - Directed and acyclic?
         - Calculate intersection turn probabilities
         - instantiate self.sinks
         Returns summary messages and a sketch of the graph.
+        incremental: only recompute the edge flows and turn probabilities affected by the changes to the roads and to
+        cars_to_sinks_dict since the last compile (see update_edge_flows). False recomputes everything.
+        processes: number of worker processes computing the flows of the sinks (or sources) in parallel, None for the
+        number of cores. Worth it for large OD matrices on city-sized graphs, the pool costs ~0.1s to start.
         """
         # Check for acyclic
         assert nx.is_directed_acyclic_graph(self.G), "Constructed road network is not acyclic. Please try again."
+        if self.adaptive_segmentation:
+            self.segment_roads()
         
         # Store sink points, give terminations attributes
         out_degrees = dict(self.G.out_degree(self.G.nodes))
-        self.sinks = [node for node in out_degrees if out_degrees[node] == 0]
-        for node in self.sinks:
+        self.sink_ids = [node for node in out_degrees if out_degrees[node] == 0]
+        self.sinks = [self.node_labels[node] for node in self.sink_ids]
+        for node in self.sink_ids:
             self.G.nodes[node]['terminations'] = 0
         
+        # Check that every sink destination is a sink reachable from its source node
+        self.reach_index = None
+        unreachable = self.unreachable_pairs(self.cars_to_sinks_dict)
+        assert not unreachable, f"{len(unreachable)} (source, sink) pairs have a sink that is not reachable from the source: {unreachable[:10]}"
+        
         # Calculate and endow intersection turn probabilities
-        edge_counts = {}
-            # Update total cars travelled for each edge
-        for source_node, sink in self.cars_to_sinks_dict.keys():
-            paths = list(nx.all_simple_edge_paths(self.G, source_node, sink))
-            # Calculate path weights from source to sink
-            path_lengths = np.zeros(len(paths))
-            for index, path in enumerate(paths):
-                total_length = 0
-                for edge in path:
-                    total_length += self.G[edge[0]][edge[1]]['length']
-                path_lengths[index] = total_length
-            path_weights = inv_weighting(path_lengths)
-            
-            # Calculate num of cars on path
-            route_num_cars = self.cars_to_sinks_dict[(source_node, sink)]
-            path_num_cars = path_weights * route_num_cars
-            
-            # Add total cars travelled for each edge
-            for index, path in enumerate(paths):
-                for edge in path:
-                    try:
-                        edge_counts[edge] += path_num_cars[index]
-                    except KeyError:
-                        edge_counts[edge] = path_num_cars[index]
-            
+            # Expected total cars travelled for each edge, cars split over paths by inverse length weighting
+        touched = self.update_edge_flows(incremental, processes)
+        
             # Endow intersections with probabilities
-        for node in self.G.nodes:
-            if node in self.input_temp_nodes:
+        input_temp_nodes = set(self.input_temp_nodes)
+        for node in touched:
+            if node in input_temp_nodes:
                 continue
             out_edges = list(self.G.out_edges(node))
             out_edges_cars = []
             for edge in out_edges:
-                out_edges_cars.append(edge_counts[edge])
+                out_edges_cars.append(self.edge_flows.get(edge, 0))
             out_edges_cars = np.array(out_edges_cars)
+            if len(out_edges) and out_edges_cars.sum() == 0: # no expected traffic, split evenly
+                out_edges_cars = np.ones(len(out_edges))
             out_edges_weights = weighting(out_edges_cars)
             for i, edge in enumerate(out_edges):
                 self.G.nodes[node][edge] = out_edges_weights[i]
+        
+        self.compile_network()
             
         if self.confirmation:
             print(f"""
@@ -241,12 +621,278 @@ class Map:
             - Sinks: {self.sinks}
             - Number of lanes used: {self.num_lanes}
             - Total length of road used: {self.total_length_of_road}
-            - Intersection turn probabilities calculated using shortest-path simple weighting. 
-              Access or manually edit through map.G.nodes attributes.
+            - Intersection turn probabilities calculated using inverse path length weighting. 
+              Access or manually edit through map.G.nodes attributes, by node id (then call map.compile_network()).
             Network sketch:
             """)
             nx.draw(self.G, self.node_positions)
         
+    def demand_arrays(self):
+        """
+        Returns cars_to_sinks_dict as arrays of source ids, sink ids and cars, one entry per (source, sink) pair.
+        """
+        num_pairs = len(self.cars_to_sinks_dict)
+        sources = np.fromiter((self.node_ids[source_node] for source_node, sink in self.cars_to_sinks_dict), dtype=np.int64, count=num_pairs)
+        sinks = np.fromiter((self.node_ids[sink] for source_node, sink in self.cars_to_sinks_dict), dtype=np.int64, count=num_pairs)
+        cars = np.fromiter(self.cars_to_sinks_dict.values(), dtype=float, count=num_pairs)
+        return sources, sinks, cars
+    
+    def update_edge_flows(self, incremental = True, processes = 1):
+        """
+        Brings self.edge_flows up to date with the roads and cars_to_sinks_dict, and returns the nodes whose turn
+        probabilities need recomputing (all nodes on the first call or when incremental is False).
+        The flows are cached per sink (or per source, when the demand has fewer sources than sinks) by road. The changes
+        since the last call are found by comparing the road lengths and the demand with the ones it saw last: a changed
+        pair dirties its group, and an added, removed or resized road (u, v) dirties the sinks reachable from v (the
+        sources reaching u), as does a road passed to mark_roads_changed (the Map road methods do). Only the dirty
+        groups are recomputed, and only intersections with changed out-flows touched.
+        The cached groups keep the quadrature of the graph they were computed on, within its ~1e-8 relative error.
+        processes: number of worker processes sharing the dirty groups, see grouped_edge_flows.
+        """
+        lengths = {(u, v): length for u, v, length in self.G.edges(data='length')}
+        sources, sinks, cars = self.demand_arrays()
+        demand = dict(zip(zip(sources.tolist(), sinks.tolist()), cars.tolist()))
+        
+        cache = self.flow_cache
+        full = not incremental or cache is None
+        if full:
+            by = 'source' if len({s for s, t in demand}) < len({t for s, t in demand}) else 'sink'
+            cache = {'by': by, 'lengths': {}, 'demand': {}, 'groups': {}, 'counts': {}, 'marked': set()}
+        by = cache['by']
+        group_of = (lambda pair: pair[1]) if by == 'sink' else (lambda pair: pair[0])
+        if full:
+            dirty = {group_of(pair) for pair in demand}
+            touched = set(self.G.nodes)
+            self.edge_flows = {}
+        else:
+            old_lengths = cache['lengths']
+            changed = [edge for edge in lengths if old_lengths.get(edge) != lengths[edge]]
+            changed += [edge for edge in old_lengths if edge not in lengths]
+            changed += [edge for edge in cache['marked'] if edge in lengths and old_lengths.get(edge) == lengths[edge]]
+            dirty = {group_of(pair) for pair in demand.keys() | cache['demand'].keys()
+                     if demand.get(pair) != cache['demand'].get(pair)}
+            # the groups downstream (upstream) of the changed roads
+            neighbors = self.G.successors if by == 'sink' else self.G.predecessors
+            stack = [v if by == 'sink' else u for u, v in changed]
+            seen = set(stack)
+            while stack:
+                for node in neighbors(stack.pop()):
+                    if node not in seen:
+                        seen.add(node)
+                        stack.append(node)
+            groups = {group_of(pair) for pair in demand} | cache['groups'].keys()
+            dirty |= seen & groups
+            touched = {u for u, v in changed}
+            # and intersections with a road left without turn probability (e.g. edited directly in self.G)
+            touched.update(u for u, v in lengths if (u, v) not in self.G.nodes[u])
+            for edge in changed:
+                if edge not in lengths:
+                    self.edge_flows.pop(edge, None)
+                    self.G.nodes[edge[0]].pop(edge, None)
+        
+        # recompute the dirty groups together, on the roads that can carry flow
+        pairs = [pair for pair in demand if group_of(pair) in dirty]
+        edges = self.live_roads(demand) if pairs else []
+        flows = grouped_edge_flows(self.G.number_of_nodes(),
+                                   [u for u, v in edges],
+                                   [v for u, v in edges],
+                                   [lengths[edge] for edge in edges],
+                                   [source for source, sink in pairs],
+                                   [sink for source, sink in pairs],
+                                   [demand[pair] for pair in pairs], by, processes=processes)
+        # apply the change of each dirty group, counting the groups on each road so that roads left without traffic get
+        # exactly 0 (and even splits) instead of rounding residue
+        delta = {}
+        counts = cache['counts']
+        for group in dirty:
+            for edge, flow in cache['groups'].pop(group, {}).items():
+                delta[edge] = delta.get(edge, 0) - flow
+                counts[edge] -= 1
+            if group in flows:
+                nonzero = np.flatnonzero(flows[group])
+                new = dict(zip([edges[i] for i in nonzero], flows[group][nonzero].tolist()))
+                for edge, flow in new.items():
+                    delta[edge] = delta.get(edge, 0) + flow
+                    counts[edge] = counts.get(edge, 0) + 1
+                cache['groups'][group] = new
+        for edge, change in delta.items():
+            if counts[edge] == 0:
+                del counts[edge]
+                if self.edge_flows.pop(edge, 0) != 0 and edge in lengths:
+                    touched.add(edge[0])
+            elif change != 0:
+                self.edge_flows[edge] = self.edge_flows.get(edge, 0) + change
+                touched.add(edge[0])
+        
+        cache['lengths'] = lengths
+        cache['demand'] = demand
+        cache['marked'] = set()
+        self.flow_cache = cache
+        return touched
+    
+    def compile_network(self):
+        """
+        Builds the array snapshot (self.network) the simulator steps on from the current graph, and resets the
+        simulation state (self.state). Called by simulation_check_compile, call it again after manually editing
+        turn probabilities or num_cars in self.G. Also builds the InflowSchedule of the demand schedules (self.schedule).
+        """
+        self.network = CompiledNetwork.from_graph(self.G, dt=self.dt, flow_constant=self.flow_constant,
+                                                  ideal_send_per_lane_per_green=self.idealSPLPG)
+        self.schedule = self.inflow_schedule()
+        self.state = self.network.initial_state()
+        self.active_set = None
+        self.sync_graph()
+    
+    def inflow_schedule(self):
+        """
+        Returns a new InflowSchedule of the demand schedules (self.schedules) on the compiled network, None without
+        schedules. The array schedules are copied in, iterator schedules are shared with the other InflowSchedules.
+        """
+        if not self.schedules:
+            return None
+        # the inflow roads have a single cell
+        road_ids = {road: road_id for road_id, road in enumerate(self.network.road_labels)}
+        cells = {node: int(self.network.road_offsets[road_ids[next(iter(self.G.out_edges(node)))]]) for node in self.schedules}
+        arrays = [(cells[node], schedule, bin_steps) for node, (schedule, bin_steps) in self.schedules.items() if isinstance(schedule, np.ndarray)]
+        streams = [(cells[node], schedule) for node, (schedule, bin_steps) in self.schedules.items() if not isinstance(schedule, np.ndarray)]
+        return InflowSchedule([cell for cell, schedule, bin_steps in arrays], [schedule for cell, schedule, bin_steps in arrays],
+                              [bin_steps for cell, schedule, bin_steps in arrays], streams, dt=self.dt)
+    
+    def sync_graph(self):
+        """
+        Writes the simulation state (num_cars, terminations) back into the graph attributes. The num_cars of a road is the
+        total over its segments.
+        """
+        num_cars = self.network.road_totals(self.state.num_cars)
+        for road_id, (u, v) in enumerate(self.network.road_labels):
+            self.G[u][v]['num_cars'] = num_cars[road_id]
+        for node in self.sink_ids:
+            self.G.nodes[node]['terminations'] = self.state.terminations[node]
+    
+    # Saving and loading compiled models
+    
+    def network_up_to_date(self):
+        """
+        Whether the compiled snapshot (self.network) still matches the roads of the graph: same roads in the same order,
+        with the same segments, lanes, capacities and turn probabilities. False after adding, removing or editing roads
+        (or turn probabilities) without compiling again.
+        """
+        roads = list(self.G.edges(data=True))
+        if [(u, v) for u, v, data in roads] != list(self.network.road_labels):
+            return False
+        first = self.network.road_offsets[:-1]
+        compiled = zip(np.diff(self.network.road_offsets).tolist(), self.network.length[first].tolist(),
+                       self.network.lanes[first].tolist(), self.network.capacity[first].tolist(), self.network.turn_prob[first].tolist())
+        return all((data['num_segs'], data['seg_length'], data['lanes'], data['capacity'], self.G.nodes[u].get((u, v), 0.0)) == road
+                   for (u, v, data), road in zip(roads, compiled))
+    
+    def save(self, path):
+        """
+        Saves the compiled model (graph, positions, turn probabilities, compiled arrays and simulation state) to a single
+        binary file that Map.load reopens with memory-maps. Node labels must be str, int, float or bool (NumPy scalars
+        included, they are loaded back as Python values), or tuples of them.
+        Array demand schedules are saved with the model, iterator schedules cannot be (their demand is not reproducible).
+        """
+        assert hasattr(self, 'network'), "Compile the model with .simulation_check_compile() before saving."
+        assert self.network_up_to_date(), "The roads changed since the last compile, call .simulation_check_compile() before saving."
+        demand_labels = self.inputs + [label for pair in self.cars_to_sinks_dict for label in pair]
+        labels = [plain_label(label) for label in self.node_labels + demand_labels]
+        unsupported = [label for label in labels if as_label(json.loads(json.dumps(label, default=repr))) != label]
+        assert not unsupported, f"Node labels must be str, int, float or bool, or tuples of them, got {unsupported[:10]}."
+        assert all(isinstance(schedule, np.ndarray) for schedule, bin_steps in self.schedules.values()), \
+            "Models with iterator schedules cannot be saved, declare array schedules instead."
+        roads = list(self.G.edges(data=True))
+        header = {'map': {'capacity_per_length_per_lane': self.capacityPLPL, 'green_lights_per_time': self.GLPT,
+                          'ideal_send_per_lane_per_green': self.idealSPLPG, 'seg_len': self.seg_len, 'dt': self.dt,
+                          'flow_constant': self.flow_constant, 'update_mode': self.update_mode, 'cell_budget': self.cell_budget,
+                          'min_cells_per_road': self.min_cells_per_road, 'max_cells_per_road': self.max_cells_per_road},
+                  'node_labels': self.node_labels,
+                  'inputs': self.inputs,
+                  'input_temp_nodes': self.input_temp_nodes,
+                  'cars_to_sinks': [[source_node, sink, cars] for (source_node, sink), cars in self.cars_to_sinks_dict.items()],
+                  'sink_ids': self.sink_ids,
+                  'num_lanes': self.num_lanes,
+                  'total_length_of_road': self.total_length_of_road,
+                  'num_nodes': self.network.num_nodes,
+                  'time': self.state.time,
+                  'schedules': [[node, bin_steps] for node, (schedule, bin_steps) in self.schedules.items()]}
+        arrays = {'node_positions': np.array(self.node_positions, dtype=float).reshape(-1, 2),
+                  'road_u': np.array([u for u, v, data in roads], dtype=np.int64),
+                  'road_v': np.array([v for u, v, data in roads], dtype=np.int64),
+                  'road_turn_prob': np.array([self.G.nodes[u].get((u, v), np.nan) for u, v, data in roads], dtype=float)}
+        for attribute in ('capacity', 'speed_limit', 'length', 'seg_length', 'num_segs', 'lanes'):
+            arrays['road_' + attribute] = np.array([data[attribute] for u, v, data in roads], dtype=float)
+        for attribute in ('edge_src', 'edge_dst', 'capacity', 'length', 'lanes', 'num_cars', 'turn_prob', 'road_offsets'):
+            arrays['cell_' + attribute] = getattr(self.network, attribute)
+        arrays['state_num_cars'] = self.state.num_cars
+        arrays['state_terminations'] = self.state.terminations
+        for k, (schedule, bin_steps) in enumerate(self.schedules.values()):
+            arrays[f'schedule_{k}'] = schedule
+        save_arrays(path, header, arrays)
+        if self.confirmation:
+            print(f"Compiled model saved to {path}.")
+    
+    @classmethod
+    def load(cls, path, seed=None, confirmation_messages=False):
+        """
+        Reopens a compiled model saved with .save, ready to simulate from the saved state. The compiled arrays are built
+        straight from the file (no recompilation), the green light orders come from a Generator seeded with seed.
+        """
+        header, arrays = load_arrays(path)
+        model = cls(confirmation_messages=confirmation_messages, seed=seed, **header['map'])
+        model.node_labels = [as_label(label) for label in header['node_labels']]
+        model.node_ids = {label: node for node, label in enumerate(model.node_labels)}
+        model.node_positions = [tuple(pos) for pos in arrays['node_positions'].tolist()]
+        model.G.add_nodes_from((node, {'label': label}) for node, label in enumerate(model.node_labels))
+        u = arrays['road_u'].tolist()
+        v = arrays['road_v'].tolist()
+        num_segs = arrays['road_num_segs'].astype(np.int64).tolist()
+        columns = zip(u, v, arrays['road_capacity'].tolist(), arrays['road_speed_limit'].tolist(), arrays['road_length'].tolist(),
+                      arrays['road_seg_length'].tolist(), num_segs, arrays['road_lanes'].tolist())
+        model.G.add_edges_from(
+            (a, b, {'capacity': cap, 'speed_limit': speed, 'length': length, 'seg_length': seg_length,
+                    'num_segs': segs, 'lanes': lanes, 'num_cars': 0})
+            for a, b, cap, speed, length, seg_length, segs, lanes in columns)
+        for a, b, prob in zip(u, v, arrays['road_turn_prob'].tolist()):
+            if not np.isnan(prob):
+                model.G.nodes[a][(a, b)] = prob
+        
+        model.inputs = [as_label(label) for label in header['inputs']]
+        model.input_temp_nodes = list(header['input_temp_nodes'])
+        model.cars_to_sinks_dict = {(as_label(source_node), as_label(sink)): cars for source_node, sink, cars in header['cars_to_sinks']}
+        model.num_lanes = header['num_lanes']
+        model.total_length_of_road = header['total_length_of_road']
+        model.sink_ids = list(header['sink_ids'])
+        model.sinks = [model.node_labels[node] for node in model.sink_ids]
+        for node in model.sink_ids:
+            model.G.nodes[node]['terminations'] = 0
+        
+        model.network = CompiledNetwork(model.node_labels, arrays['cell_edge_src'], arrays['cell_edge_dst'], arrays['cell_capacity'],
+                                        arrays['cell_length'], arrays['cell_lanes'], arrays['cell_num_cars'], arrays['cell_turn_prob'],
+                                        road_offsets=arrays['cell_road_offsets'], num_nodes=header['num_nodes'], dt=model.dt,
+                                        flow_constant=model.flow_constant, ideal_send_per_lane_per_green=model.idealSPLPG)
+        model.network.road_labels = list(zip(u, v))
+        model.state = SimulationState(np.array(arrays['state_num_cars']), np.array(arrays['state_terminations']))
+        model.state.time = header['time']
+        model.schedules = {node: (np.array(arrays[f'schedule_{k}']), bin_steps) for k, (node, bin_steps) in enumerate(header.get('schedules', []))}
+        model.schedule = model.inflow_schedule()
+        model.active_set = None
+        model.sync_graph()
+        if model.confirmation:
+            print(f"Compiled model loaded from {path}.")
+        return model
+    
+    def ensemble(self, replicas=100, seed=None):
+        """
+        Returns an Ensemble of replicas of the compiled network, stepped together with their own green light orders.
+        Use .run(steps) and .statistics() for the mean and variance of num_cars and terminations.
+        Replica r draws the same orders as a Map reseeded with .reseed(ensemble.replica_seeds[r]).
+        The ensemble gets its own InflowSchedule of the Map's array schedules (iterator schedules cannot be shared).
+        """
+        assert all(isinstance(schedule, np.ndarray) for schedule, bin_steps in self.schedules.values()), \
+            "Iterator schedules cannot be shared with an ensemble, declare array schedules instead."
+        return Ensemble(self.network, replicas=replicas, seed=seed, schedule=self.inflow_schedule())
+    
     # Simulation, time-step update for road network
     
     def update_time(self):
@@ -255,88 +901,125 @@ class Map:
         1. Randomizing the order of the green lights
         2. Calculating speed_factors and num_cars to send for each edge
         3. Updating num_cars for each edge after each send into intersection
+        The step runs on the compiled arrays (self.network, self.state), the graph attributes are synced afterwards.
+        With update_mode = "synchronous", all edges send at once instead (no green light order), with "batched",
+        the green light order is over independent batches of edges, with "active", only active edges get green lights.
         """
-        # loop through each edge non-simultaneously for each time step ("green light-red light")
-        # green_lights = [random.randint(0, len(self.G.edges)-1) for _ in range(self.GLPT)]
-        green_lights = [i for i in range(len(self.G.edges))]
-        random.shuffle(green_lights)
-        for green_light in green_lights:
-            edge = list(self.G.edges)[green_light]
-            inter = edge[1]
-            out_edges = list(self.G.out_edges(inter))
-
-            # handle case leading to sink
-            """
-            if len(out_edges) == 0:
-                speed_factor = max(self.G[edge[0]][edge[1]]['capacity'] - self.G[edge[0]][edge[1]]['num_cars'],0) / self.G[edge[0]][edge[1]]['capacity'] + 0.2
-                #print(speed_factor)
-                # send calculated amount, or remaining cars in road
-                to_send_num = min(self.idealSPLPG * self.G[edge[0]][edge[1]]['lanes'] * speed_factor, self.G[edge[0]][edge[1]]['num_cars'])
-                if to_send_num == 0:
-                    pass
-                self.G.nodes[inter]['terminations'] += to_send_num
-                self.G[edge[0]][edge[1]]['num_cars'] -= to_send_num
-                pass
-            """
-
-            to_send = {out_edge: self.G.nodes[inter][out_edge] for out_edge in out_edges}
-            # between r>0 and 1, note that r attains smaller positive value iff road capacity is large (i.e. a huge jammed multi-lane highway vs. local road)
-
-            # the max possible that can be sent without overflow
-            fluxes = [(self.G[out_edge[0]][out_edge[1]]['capacity'] - self.G[out_edge[0]][out_edge[1]]['num_cars'])/to_send[out_edge] for out_edge in out_edges]
-            fluxes = np.array(fluxes)
-            try:
-                out_flux_cap = float(np.min(fluxes))
-                ### Is this how the system works 
-                
-                # take into account speed
-                max_out_flux = min(out_flux_cap,  self.G[edge[0]][edge[1]]['num_cars'] * self.dt * self.flow_constant / self.G[edge[0]][edge[1]]['length']) 
-                # take into account lanes????
-                to_send_num = min(max_out_flux, self.G[edge[0]][edge[1]]['num_cars'])
-
-
-
-                #speed_factor = max(self.G[edge[0]][edge[1]]['capacity'] - self.G[edge[0]][edge[1]]['num_cars'],0) / self.G[edge[0]][edge[1]]['capacity'] + 0.2 # old version
-                # send calculated amount, or remaining cars in road
-                #to_send_num = min(self.idealSPLPG * self.G[edge[0]][edge[1]]['lanes'] * speed_factor, self.G[edge[0]][edge[1]]['num_cars']) # old version
-                
-            except ValueError: # if it is a sink, min will be empty
-                speed_factor = max(self.G[edge[0]][edge[1]]['capacity'] - self.G[edge[0]][edge[1]]['num_cars'],0) / self.G[edge[0]][edge[1]]['capacity'] + 0.2
-                #print(speed_factor)
-                # send calculated amount, or remaining cars in road
-                to_send_num = min(self.idealSPLPG * self.G[edge[0]][edge[1]]['lanes'] * speed_factor, self.G[edge[0]][edge[1]]['num_cars'])
-                if to_send_num == 0:
-                    pass
-                self.G.nodes[inter]['terminations'] += to_send_num
-                self.G[edge[0]][edge[1]]['num_cars'] -= to_send_num
-
-
-            # Send cars, check for capacity, retain if overflow, remove cars from edge
-
-            for out_edge in to_send:
-                num_send = to_send[out_edge] * to_send_num
-                self.G[edge[0]][edge[1]]['num_cars'] -= num_send
-                self.G[out_edge[0]][out_edge[1]]['num_cars'] += num_send
-            """
-            for out_edge in to_send:
-                num_send = to_send[out_edge] * to_send_num
-                would_be_capacity = num_send + self.G[out_edge[0]][out_edge[1]]['num_cars']
-                if would_be_capacity > self.G[out_edge[0]][out_edge[1]]['capacity']:
-                    actual_sent = self.G[out_edge[0]][out_edge[1]]['capacity'] - self.G[out_edge[0]][out_edge[1]]['num_cars']
-                    self.G[edge[0]][edge[1]]['num_cars'] -= actual_sent
-                    self.G[out_edge[0]][out_edge[1]]['num_cars'] = self.G[out_edge[0]][out_edge[1]]['capacity']
-                else:
-                    self.G[edge[0]][edge[1]]['num_cars'] -= num_send
-                    self.G[out_edge[0]][out_edge[1]]['num_cars'] += num_send"
-            """
-            # I don't think I need this
-
-
-
-
-                    
-                
-            
-            
-            
+        self.step_state()
+        self.sync_graph()
+    
+    def step_state(self):
+        """
+        Moves the compiled state (self.state) forward one time-step using self.update_mode, without touching the graph.
+        The cars of the demand schedules enter at the start of the step.
+        The active set of update_mode = "active" is built at the first active step and dropped by the other modes, so
+        update_mode can be changed between steps.
+        """
+        if self.update_mode != "active":
+            self.active_set = None
+        elif self.active_set is None:
+            self.active_set = ActiveSet(self.network, self.state)
+        if self.schedule is not None:
+            added = self.schedule.inject(self.state.num_cars, self.state.time)
+            if self.active_set is not None:
+                self.active_set.touch(added)
+        if self.update_mode == "synchronous":
+            step_synchronous(self.network, self.state)
+        elif self.update_mode == "batched":
+            # green lights for whole batches of independent edges, in random order
+            green_lights = self.next_green_lights(np.arange(len(self.network.level_batches())))
+            step_batched(self.network, self.state, green_lights)
+        elif self.update_mode == "active":
+            # green lights only for edges with cars and room downstream, in random order (drawn as the step goes)
+            replayed = self.replayed_green_lights()
+            green_lights = step_active(self.network, self.state, self.active_set, rng=self.rng,
+                                       order=None if replayed is None else np.asarray(replayed, dtype=np.int64).tolist())
+            self.log_green_lights(green_lights)
+        else:
+            # loop through each edge non-simultaneously for each time step ("green light-red light")
+            green_lights = self.next_green_lights(np.arange(self.network.num_edges))
+            step_sequential(self.network, self.state, green_lights)
+    
+    # Random number generation, recording and replaying green light orders
+    
+    def reseed(self, seed = None):
+        """
+        Replaces the Map's NumPy Generator (self.rng) by a new one seeded with seed.
+        """
+        self.seed = seed
+        self.rng = np.random.default_rng(seed)
+    
+    def record_green_lights(self):
+        """
+        Starts recording the green light order of every following time-step into self.green_light_log (a list of arrays).
+        """
+        self.green_light_log = []
+    
+    def replay_green_lights(self, log):
+        """
+        Makes the following time-steps use the green light orders in log (e.g. a recorded self.green_light_log) instead
+        of drawing them from self.rng, until log runs out.
+        """
+        self.green_light_replay = iter(list(log))
+    
+    def next_green_lights(self, green_lights):
+        """
+        Returns the green light order for the next time-step: a replayed order if replaying, otherwise a random
+        permutation of green_lights, sorted by uniform keys drawn from self.rng (as Ensemble draws its replicas' orders).
+        Records the order if recording.
+        """
+        order = self.replayed_green_lights()
+        if order is None:
+            order = np.asarray(green_lights)[np.argsort(self.rng.random(len(green_lights)))]
+        return self.log_green_lights(order)
+    
+    def replayed_green_lights(self):
+        """
+        Returns the next replayed green light order, None if not replaying (replaying stops when the log runs out).
+        """
+        order = next(self.green_light_replay, None) if self.green_light_replay is not None else None
+        if order is None:
+            self.green_light_replay = None
+        return order
+    
+    def log_green_lights(self, order):
+        """
+        Records the green light order of a time-step if recording. Returns it as an array.
+        """
+        order = np.asarray(order, dtype=np.int64)
+        if self.green_light_log is not None:
+            self.green_light_log.append(order)
+        return order
+    
+    def run_until_drained(self, tol = 1e-3, max_steps = 10000):
+        """
+        Runs the simulation headless from the current state until the cars remaining on the roads fall below tol
+        (fractional flows never reach exactly zero) and the demand schedules have finished, or for at most max_steps
+        time-steps. The graph is synced at the end.
+        Returns:
+        episodes: the number of time-steps until drained, None if the network did not drain within max_steps.
+        arrival_times: dict of sink -> the time-step at which the sink's terminations came within tol of their final
+        value, None for sinks that received no cars.
+        """
+        sinks = self.sink_ids
+        history = [self.state.terminations[sinks].copy()]
+        steps = 0
+        pending = lambda: self.schedule is not None and not self.schedule.finished(self.state.time)
+        while (self.state.num_cars.sum() >= tol or pending()) and steps < max_steps:
+            self.step_state()
+            history.append(self.state.terminations[sinks].copy())
+            steps += 1
+        self.sync_graph()
         
+        history = np.array(history)
+        final = history[-1]
+        arrival_times = {}
+        for i, sink in enumerate(self.sinks):
+            if final[i] - history[0, i] < tol:
+                arrival_times[sink] = None
+            else:
+                arrival_times[sink] = int(np.argmax(history[:, i] >= final[i] - tol))
+        episodes = steps if self.state.num_cars.sum() < tol and not pending() else None
+        if self.confirmation:
+            print(f"Drained after {episodes} episodes." if episodes is not None else f"Not drained after {max_steps} episodes.")
+        return episodes, arrival_times
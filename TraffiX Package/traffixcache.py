@@ -0,0 +1,529 @@
+# This module builds TraffiX models from the raw Overpass API responses that osmnx caches as JSON (see cache/),
+# without osmnx or network access, e.g. on machines that can't reach OpenStreetMap.
+# The main function is overpass_to_traffix_model
+
+import hashlib
+import json
+import os
+import re
+import shutil
+import time
+import numpy as np
+import networkx as nx
+from traffix import Map
+from traffixearth import graph_to_traffix_model
+
+# osmnx writes its cache next to the notebooks that call it
+CACHE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "cache")
+# same as osmnx
+EARTH_RADIUS_M = 6371009
+
+# the osmnx "drive" network filter
+EXCLUDED_HIGHWAYS = {"abandoned", "bridleway", "bus_guideway", "busway", "construction", "corridor", "cycleway",
+                     "elevator", "escalator", "footway", "no", "path", "pedestrian", "planned", "platform", "proposed",
+                     "raceway", "razed", "service", "steps", "track"}
+EXCLUDED_SERVICES = {"alley", "driveway", "emergency_access", "parking", "parking_aisle", "private"}
+ONEWAY_VALUES = {"yes", "true", "1"}
+REVERSED_ONEWAY_VALUES = {"-1", "reverse"}
+
+_SEPARATOR = re.compile(r"[\s,]*")
+
+def cache_files(cache_dir=CACHE_DIR):
+    """
+    Returns the paths of the cached Overpass responses (.json files) in cache_dir, sorted by name.
+    """
+    return sorted(os.path.join(cache_dir, name) for name in os.listdir(cache_dir) if name.endswith(".json"))
+
+def iter_elements(path, chunk_size=1 << 16):
+    """
+    Streams the "elements" of an Overpass JSON response one at a time, reading path in chunks of chunk_size characters
+    instead of loading the whole document.
+    """
+    decoder = json.JSONDecoder()
+    with open(path, encoding="utf-8") as file:
+        buffer = ""
+        # skip the header up to the start of the elements array
+        while True:
+            start = buffer.find('"elements"')
+            if start >= 0:
+                start = buffer.find("[", start)
+                if start >= 0:
+                    break
+            chunk = file.read(chunk_size)
+            if not chunk:
+                return
+            buffer += chunk
+        pos = start + 1
+        eof = False
+        while True:
+            pos = _SEPARATOR.match(buffer, pos).end()
+            if pos < len(buffer) and buffer[pos] == "]":
+                return
+            try:
+                element, pos = decoder.raw_decode(buffer, pos)
+            except json.JSONDecodeError:
+                # the next element runs past the end of the buffer
+                assert not eof, f"{path} is not a complete Overpass response."
+                chunk = file.read(chunk_size)
+                eof = not chunk
+                buffer = buffer[pos:] + chunk
+                pos = 0
+                continue
+            yield element
+
+def is_drivable(tags):
+    """
+    Whether a way with these tags is part of the osmnx "drive" network.
+    """
+    return ("highway" in tags and tags["highway"] not in EXCLUDED_HIGHWAYS
+            and tags.get("area") != "yes"
+            and tags.get("motor_vehicle") != "no" and tags.get("motorcar") != "no"
+            and tags.get("access") != "private"
+            and tags.get("service") not in EXCLUDED_SERVICES)
+
+def haversine(lat1, lon1, lat2, lon2):
+    """
+    Great-circle distances in meters between arrays of (lat, lon) points in degrees.
+    """
+    lat1, lon1, lat2, lon2 = (np.radians(a) for a in (lat1, lon1, lat2, lon2))
+    h = np.sin((lat2 - lat1) / 2) ** 2 + np.cos(lat1) * np.cos(lat2) * np.sin((lon2 - lon1) / 2) ** 2
+    return 2 * EARTH_RADIUS_M * np.arcsin(np.sqrt(h))
+
+def parse_overpass(paths):
+    """
+    Parses Overpass responses into a compact columnar form, a dict of arrays:
+    - node_id, lat, lon: the nodes used by ways
+    - way_id, way_offsets, way_nodes: the ways, way w being the nodes way_nodes[way_offsets[w]:way_offsets[w + 1]]
+      (positions in the node arrays)
+    - tag_offsets, tag_keys, tag_values: the way tags, way w having the tags key tag_keys[i] = value tag_values[i]
+      for i in tag_offsets[w]:tag_offsets[w + 1]
+    - key_bytes, key_offsets, value_bytes, value_offsets: the distinct tag keys and values, as UTF-8 bytes back to back
+    Elements repeated across responses are only used once, ways with missing nodes are dropped.
+    """
+    node_index = {}
+    lats, lons = [], []
+    ways = {}
+    for path in paths:
+        for element in iter_elements(path):
+            if element["type"] == "node":
+                if element["id"] not in node_index:
+                    node_index[element["id"]] = len(lats)
+                    lats.append(element["lat"])
+                    lons.append(element["lon"])
+            elif element["type"] == "way":
+                ways[element["id"]] = element
+    ways = [way for way in ways.values() if all(node in node_index for node in way["nodes"])]
+    sizes = [len(way["nodes"]) for way in ways]
+    way_nodes = np.fromiter((node_index[node] for way in ways for node in way["nodes"]), dtype=np.int64, count=sum(sizes))
+    # only keep the nodes on ways
+    used, way_nodes = np.unique(way_nodes, return_inverse=True)
+    key_index, value_index = {}, {}
+    tag_keys, tag_values, tag_sizes = [], [], []
+    for way in ways:
+        tags = way.get("tags", {})
+        tag_sizes.append(len(tags))
+        for key, value in tags.items():
+            tag_keys.append(key_index.setdefault(key, len(key_index)))
+            tag_values.append(value_index.setdefault(value, len(value_index)))
+    return {'node_id': np.fromiter(node_index, dtype=np.int64, count=len(node_index))[used],
+            'lat': np.array(lats, dtype=float)[used], 'lon': np.array(lons, dtype=float)[used],
+            'way_id': np.array([way["id"] for way in ways], dtype=np.int64),
+            'way_offsets': np.concatenate([[0], np.cumsum(sizes, dtype=np.int64)]),
+            'way_nodes': way_nodes.astype(np.int32),
+            'tag_offsets': np.concatenate([[0], np.cumsum(tag_sizes, dtype=np.int64)]),
+            'tag_keys': np.array(tag_keys, dtype=np.int32), 'tag_values': np.array(tag_values, dtype=np.int32),
+            **_pack_strings('key', key_index), **_pack_strings('value', value_index)}
+
+def _pack_strings(name, strings):
+    """
+    Stores strings as their UTF-8 bytes back to back (name_bytes) with the offsets of each one (name_offsets),
+    which takes far less room than a fixed-width unicode array.
+    """
+    encoded = [string.encode("utf-8") for string in strings]
+    return {name + '_bytes': np.frombuffer(b"".join(encoded), dtype=np.uint8),
+            name + '_offsets': np.concatenate([[0], np.cumsum([len(data) for data in encoded], dtype=np.int64)])}
+
+def _unpack_strings(columns, name):
+    data = np.asarray(columns[name + '_bytes']).tobytes()
+    offsets = np.asarray(columns[name + '_offsets']).tolist()
+    return [data[a:b].decode("utf-8") for a, b in zip(offsets[:-1], offsets[1:])]
+
+def way_tags(columns):
+    """
+    Returns the tags of every way of a columnar response (see parse_overpass) as a list of dicts.
+    """
+    key_names = _unpack_strings(columns, 'key')
+    value_names = _unpack_strings(columns, 'value')
+    keys = columns['tag_keys'].tolist()
+    values = columns['tag_values'].tolist()
+    offsets = columns['tag_offsets'].tolist()
+    return [{key_names[keys[i]]: value_names[values[i]] for i in range(a, b)} for a, b in zip(offsets[:-1], offsets[1:])]
+
+def columns_to_graph(columns):
+    """
+    Returns the drivable network of a columnar response (see parse_overpass) as a MultiDiGraph in the osmnx layout:
+    nodes are OSM node ids with x (lon) and y (lat), edges have length (meters), lanes, highway and osmid (the way id).
+    Ways are split at intersections (nodes shared by several ways) and at their ends, two-way roads get an edge in
+    each direction and one-way roads (oneway tag, roundabouts) a single one.
+    """
+    node_ids = np.asarray(columns['node_id'])
+    lats = np.asarray(columns['lat'])
+    lons = np.asarray(columns['lon'])
+    tags = way_tags(columns)
+    sizes = np.diff(columns['way_offsets'])
+    keep = (sizes > 1) & np.array([is_drivable(way) for way in tags], dtype=bool)
+    G = nx.MultiDiGraph()
+    if not keep.any():
+        return G
+    ways = np.flatnonzero(keep)
+    sizes = sizes[keep]
+    # all way nodes back to back, with the way of each position
+    seq = np.asarray(columns['way_nodes'])[np.repeat(keep, np.diff(columns['way_offsets']))].astype(np.int64)
+    way_of = np.repeat(np.arange(len(ways)), sizes)
+    first = np.zeros(len(seq), dtype=bool)
+    first[np.cumsum(sizes)[:-1]] = True
+    first[0] = True
+    # intersections: nodes on several ways (or twice on one) and way ends
+    uses = np.bincount(seq, minlength=len(node_ids))
+    ends = first | np.roll(first, -1)
+    uses[seq[ends]] += 2
+
+    # consecutive pairs of nodes on the same way, a new road starts at the first node of a way or at an intersection
+    pairs = np.flatnonzero(way_of[:-1] == way_of[1:])
+    lengths = haversine(lats[seq[pairs]], lons[seq[pairs]], lats[seq[pairs + 1]], lons[seq[pairs + 1]])
+    starts = first[pairs] | (uses[seq[pairs]] > 1)
+    road_of = np.cumsum(starts) - 1
+    road_length = np.bincount(road_of, weights=lengths)
+    first_pair = pairs[starts]
+    last_pair = pairs[np.append(np.flatnonzero(starts)[1:] - 1, len(pairs) - 1)]
+    u = node_ids[seq[first_pair]]
+    v = node_ids[seq[last_pair + 1]]
+    road_way = ways[way_of[first_pair]]
+
+    used = np.unique(np.concatenate([seq[first_pair], seq[last_pair + 1]]))
+    G.add_nodes_from((node, {'x': x, 'y': y}) for node, x, y in zip(node_ids[used].tolist(), lons[used].tolist(), lats[used].tolist()))
+    way_ids = columns['way_id']
+    edges = []
+    for a, b, length, w in zip(u.tolist(), v.tolist(), road_length.tolist(), road_way.tolist()):
+        data = {'length': length, 'lanes': tags[w].get("lanes"), 'highway': tags[w]["highway"], 'osmid': int(way_ids[w])}
+        oneway = tags[w].get("oneway")
+        if oneway in REVERSED_ONEWAY_VALUES:
+            edges.append((b, a, data))
+            continue
+        edges.append((a, b, data))
+        if oneway not in ONEWAY_VALUES and tags[w].get("junction") != "roundabout":
+            edges.append((b, a, dict(data)))
+    G.add_edges_from(edges)
+    return G
+
+def crop_columns(columns, bbox):
+    """
+    Returns the part of a columnar response (see parse_overpass) inside bbox (west, south, east, north), as osmnx
+    truncates its downloads: the nodes outside are dropped and the ways split where they leave the box.
+    """
+    west, south, east, north = bbox
+    lats = np.asarray(columns['lat'])
+    lons = np.asarray(columns['lon'])
+    inside = (lons >= west) & (lons <= east) & (lats >= south) & (lats <= north)
+    way_nodes = np.asarray(columns['way_nodes']).astype(np.int64)
+    way_of = np.repeat(np.arange(len(columns['way_id'])), np.diff(columns['way_offsets']))
+    # runs of consecutive inside nodes of a way become ways of their own, single nodes are dropped
+    keep = inside[way_nodes]
+    start = keep.copy()
+    start[1:] &= ~(keep[:-1] & (way_of[1:] == way_of[:-1]))
+    run_of = np.cumsum(start) - 1
+    run_sizes = np.bincount(run_of[keep], minlength=int(start.sum()))
+    run_way = way_of[start][run_sizes > 1]
+    keep &= (run_sizes > 1)[run_of]
+    sizes = run_sizes[run_sizes > 1]
+    used, way_nodes = np.unique(way_nodes[keep], return_inverse=True)
+    tag_offsets = np.asarray(columns['tag_offsets'])
+    tag_sizes = np.diff(tag_offsets)[run_way]
+    new_tag_offsets = np.concatenate([[0], np.cumsum(tag_sizes, dtype=np.int64)])
+    tags = np.repeat(tag_offsets[run_way] - new_tag_offsets[:-1], tag_sizes) + np.arange(new_tag_offsets[-1])
+    return {**columns,
+            'node_id': np.asarray(columns['node_id'])[used], 'lat': lats[used], 'lon': lons[used],
+            'way_id': np.asarray(columns['way_id'])[run_way],
+            'way_offsets': np.concatenate([[0], np.cumsum(sizes, dtype=np.int64)]),
+            'way_nodes': way_nodes.astype(np.int32),
+            'tag_offsets': new_tag_offsets,
+            'tag_keys': np.asarray(columns['tag_keys'])[tags], 'tag_values': np.asarray(columns['tag_values'])[tags]}
+
+def read_overpass(paths):
+    """
+    Parses Overpass responses and returns their drivable network as a MultiDiGraph, see columns_to_graph.
+    """
+    return columns_to_graph(parse_overpass(paths))
+
+def bbox_from_point(coordinates, dist):
+    """
+    Returns the (west, south, east, north) bounding box of the square of half-side dist meters around
+    coordinates (lat, lon), the area osmnx keeps for graph_from_point.
+    """
+    lat, lon = coordinates
+    delta_lat = dist / EARTH_RADIUS_M * 180 / np.pi
+    delta_lon = delta_lat / np.cos(np.radians(lat))
+    return (lon - delta_lon, lat - delta_lat, lon + delta_lon, lat + delta_lat)
+
+def default_cache_root():
+    """
+    The TraffiX cache directory shared by all projects: $TRAFFIX_CACHE, or ~/.cache/traffix.
+    """
+    return os.environ.get("TRAFFIX_CACHE") or os.path.join(os.path.expanduser("~"), ".cache", "traffix")
+
+class BinaryCache:
+    """
+    TraffiX-managed cache of OSM downloads in the columnar form of parse_overpass, one directory of .npy files per
+    distinct content (so repeated downloads, e.g. the same response cached by several projects, are stored once),
+    keyed by (bbox, network_type). Arrays are loaded as memory-maps. The total size is bounded by max_bytes, evicting
+    the least recently used content first.
+    """
+    
+    def __init__(self, root=None, max_bytes=1 << 30):
+        """
+        Parameters:
+        root: cache directory, defaults to $TRAFFIX_CACHE or ~/.cache/traffix, shared by all projects.
+        max_bytes: bound on the total size of the stored arrays.
+        """
+        self.root = root or default_cache_root()
+        self.max_bytes = max_bytes
+        os.makedirs(self.root, exist_ok=True)
+        self.index_path = os.path.join(self.root, "index.json")
+        if os.path.exists(self.index_path):
+            with open(self.index_path) as file:
+                self.index = json.load(file)
+        else:
+            # entries: key -> bbox, network_type and content hash, contents: hash -> bytes and last use,
+            # files: imported JSON responses -> content hash (None if empty)
+            self.index = {'entries': {}, 'contents': {}, 'files': {}}
+    
+    @staticmethod
+    def key(bbox, network_type):
+        return f"{network_type}:" + ",".join(f"{coord:.7f}" for coord in bbox)
+    
+    def save_index(self):
+        tmp = self.index_path + ".tmp"
+        with open(tmp, "w") as file:
+            json.dump(self.index, file)
+        os.replace(tmp, self.index_path)
+    
+    def total_bytes(self):
+        return sum(content['bytes'] for content in self.index['contents'].values())
+    
+    def put(self, bbox, network_type, columns, keep=()):
+        """
+        Stores a columnar response (see parse_overpass) under (bbox, network_type) and returns its content hash.
+        The stored content and the contents in keep are not evicted by this call, even over max_bytes.
+        """
+        digest = hashlib.sha1()
+        for name in sorted(columns):
+            array = np.ascontiguousarray(columns[name])
+            digest.update(f"{name}:{array.dtype.str}:{array.shape};".encode())
+            digest.update(array.tobytes())
+        content = digest.hexdigest()
+        folder = os.path.join(self.root, content)
+        if content not in self.index['contents'] or not os.path.isdir(folder):
+            tmp = folder + ".tmp"
+            shutil.rmtree(tmp, ignore_errors=True)
+            os.makedirs(tmp)
+            for name, array in columns.items():
+                np.save(os.path.join(tmp, name + ".npy"), np.asarray(array))
+            shutil.rmtree(folder, ignore_errors=True)
+            os.replace(tmp, folder)
+            size = sum(os.path.getsize(os.path.join(folder, name)) for name in os.listdir(folder))
+            self.index['contents'][content] = {'bytes': size, 'last_used': time.time()}
+        self.index['entries'][self.key(bbox, network_type)] = {'bbox': list(bbox), 'network_type': network_type, 'content': content}
+        self.index['contents'][content]['last_used'] = time.time()
+        self.evict(keep={content, *keep})
+        return content
+    
+    def get(self, bbox, network_type):
+        """
+        Returns the memory-mapped columns stored under (bbox, network_type), or else of the smallest stored region
+        of that network_type containing bbox, or None.
+        """
+        entry = self.index['entries'].get(self.key(bbox, network_type))
+        if entry is None:
+            west, south, east, north = bbox
+            covering = [entry for entry in self.index['entries'].values() if entry['network_type'] == network_type
+                        and entry['bbox'][0] <= west and entry['bbox'][1] <= south
+                        and entry['bbox'][2] >= east and entry['bbox'][3] >= north]
+            if not covering:
+                return None
+            entry = min(covering, key=lambda entry: (entry['bbox'][2] - entry['bbox'][0]) * (entry['bbox'][3] - entry['bbox'][1]))
+        folder = os.path.join(self.root, entry['content'])
+        if not os.path.isdir(folder):
+            return None
+        self.index['contents'][entry['content']]['last_used'] = time.time()
+        self.save_index()
+        return {name[:-4]: np.load(os.path.join(folder, name), mmap_mode="r") for name in os.listdir(folder) if name.endswith(".npy")}
+    
+    def import_json(self, source, network_type="drive"):
+        """
+        Converts cached Overpass responses (a .json file, a list of them or directories of them, e.g. the osmnx
+        cache folders of several projects) into the binary cache, each keyed by the bounding box of its nodes.
+        Files imported before are skipped. Returns the content hash of each file (None for empty responses).
+        The imported contents are not evicted by this call, even over max_bytes.
+        """
+        sources = [source] if isinstance(source, str) else list(source)
+        paths = [path for source in sources for path in (cache_files(source) if os.path.isdir(source) else [source])]
+        imported = {}
+        for path in paths:
+            stat = os.stat(path)
+            record = self.index['files'].get(os.path.abspath(path))
+            if record is not None and record['mtime'] == stat.st_mtime and record['size'] == stat.st_size \
+                    and (record['content'] is None or record['content'] in self.index['contents']):
+                imported[path] = record['content']
+                continue
+            columns = parse_overpass([path])
+            content = None
+            if len(columns['node_id']):
+                bbox = (columns['lon'].min(), columns['lat'].min(), columns['lon'].max(), columns['lat'].max())
+                content = self.put(tuple(float(coord) for coord in bbox), network_type, columns, keep=set(imported.values()))
+            self.index['files'][os.path.abspath(path)] = {'mtime': stat.st_mtime, 'size': stat.st_size, 'content': content}
+            imported[path] = content
+        self.save_index()
+        return imported
+    
+    def evict(self, max_bytes=None, keep=()):
+        """
+        Removes the least recently used contents (and their keys) until the cache is at most max_bytes
+        (default self.max_bytes). Contents in keep are never removed.
+        """
+        max_bytes = self.max_bytes if max_bytes is None else max_bytes
+        contents = self.index['contents']
+        total = self.total_bytes()
+        for content in sorted(contents, key=lambda content: contents[content]['last_used']):
+            if total <= max_bytes:
+                break
+            if content in keep:
+                continue
+            total -= contents.pop(content)['bytes']
+            shutil.rmtree(os.path.join(self.root, content), ignore_errors=True)
+        self.index['entries'] = {key: entry for key, entry in self.index['entries'].items() if entry['content'] in contents}
+        self.index['files'] = {path: record for path, record in self.index['files'].items()
+                               if record['content'] is None or record['content'] in contents}
+        self.save_index()
+
+def overpass_to_traffix_model(source, seg_len=50, draw=None, max_nodes=None, cycle_method=None,
+                              cycle_weight=None, contract=True, **map_kwargs):
+    """
+    Builds a model able to be simulated with TraffiX from cached Overpass responses, offline and without osmnx.
+    Arguments
+    source - a response (.json file), a list of them, a directory of them (merged, as osmnx splits large queries),
+             or columns from parse_overpass/BinaryCache.get
+    seg_len - seg_len of the model, lengths are rounded to multiples of 50 so 50 (default) or a divisor avoids rounding twice
+    See traffixearth.irl_to_traffix_model for the other arguments.
+    The time spent in each stage is printed and stored in model.build_timings.
+    """
+    clock = time.perf_counter()
+    if isinstance(source, dict):
+        G_raw = columns_to_graph(source)
+        description = "cached OSM road network"
+    else:
+        if isinstance(source, str):
+            paths = cache_files(source) if os.path.isdir(source) else [source]
+        else:
+            paths = list(source)
+        G_raw = read_overpass(paths)
+        description = f"cached OSM road network ({len(paths)} response{'s' if len(paths) != 1 else ''})"
+    timings = {'parse': time.perf_counter() - clock}
+    return graph_to_traffix_model(G_raw, seg_len, description, draw=draw, max_nodes=max_nodes, cycle_method=cycle_method,
+                                  cycle_weight=cycle_weight, contract=contract, timings=timings, **map_kwargs)
+
+def region_to_traffix_model(coordinates, radius, cache=None, **kwargs):
+    """
+    Same as traffixearth.irl_to_traffix_model, but through the binary cache: repeat regions are memory-mapped instead
+    of downloaded and parsed again. On a miss, the area is downloaded with osmnx and the responses it writes to its
+    cache folder are added to the binary cache. The model only covers bbox_from_point(coordinates, radius), the cached
+    area (a larger region covering it, or the buffered download) is cropped to it with crop_columns.
+    Arguments
+    cache - BinaryCache to use, defaults to BinaryCache()
+    kwargs - seg_len (default radius/10, as irl_to_traffix_model) and the other irl_to_traffix_model arguments
+    """
+    cache = BinaryCache() if cache is None else cache
+    bbox = bbox_from_point(coordinates, radius)
+    clock = time.perf_counter()
+    columns = cache.get(bbox, "drive")
+    if columns is None:
+        import osmnx as ox
+        folder = ox.settings.cache_folder
+        before = set(cache_files(folder)) if os.path.isdir(folder) else set()
+        ox.graph.graph_from_point(coordinates, dist=radius, network_type="drive")
+        new = sorted(set(cache_files(folder)) - before)
+        if new:
+            columns = parse_overpass(new)
+            cache.put(bbox, "drive", columns)
+        else:
+            # osmnx answered from its own cache, which may not have been imported yet
+            cache.import_json(folder)
+            columns = cache.get(bbox, "drive")
+        assert columns is not None, "The downloaded responses are not in the osmnx cache folder, enable ox.settings.use_cache."
+    timings = {'cache': time.perf_counter() - clock}
+    G_raw = columns_to_graph(crop_columns(columns, bbox))
+    timings['parse'] = time.perf_counter() - clock - timings['cache']
+    seg_len = kwargs.pop('seg_len', radius/10)
+    return graph_to_traffix_model(G_raw, seg_len, f"cached OSM road network at {coordinates} with radius {radius}",
+                                  timings=timings, **kwargs)
+
+def model_key(coordinates, radius, seg_len, demand, **map_kwargs):
+    """
+    Content hash identifying a compiled region model: coordinates, radius, seg_len, OD demand (dict of
+    source -> {sink: cars}, as in declare_inflow_node) and any other Map arguments.
+    """
+    pairs = sorted(([source, sink, float(cars)] for source in demand for sink, cars in demand[source].items()), key=repr)
+    content = {'coordinates': [float(coord) for coord in coordinates], 'radius': float(radius), 'seg_len': float(seg_len),
+               'demand': pairs, 'map': map_kwargs}
+    return hashlib.sha1(json.dumps(content, sort_keys=True, default=repr).encode("utf-8")).hexdigest()
+
+class ModelStore:
+    """
+    On-disk store of compiled models (Map.save files) by key, e.g. a model_key.
+    """
+    
+    def __init__(self, root=None):
+        """
+        Parameters:
+        root: store directory, defaults to the models folder of the BinaryCache directory.
+        """
+        self.root = root or os.path.join(default_cache_root(), "models")
+        os.makedirs(self.root, exist_ok=True)
+    
+    def path(self, key):
+        return os.path.join(self.root, key + ".trfx")
+    
+    def __contains__(self, key):
+        return os.path.exists(self.path(key))
+    
+    def save(self, key, model):
+        model.save(self.path(key))
+    
+    def load(self, key, seed=None):
+        """
+        Returns the stored compiled model, or None.
+        """
+        return Map.load(self.path(key), seed=seed) if key in self else None
+
+def compiled_region_model(coordinates, radius, demand, seg_len=None, store=None, cache=None, **kwargs):
+    """
+    Returns a compiled model of a region with the given OD demand (dict of source -> {sink: cars}), reopened from the
+    ModelStore when this (coordinates, radius, seg_len, demand, Map arguments) was compiled before, otherwise built with
+    region_to_traffix_model, compiled and stored.
+    Arguments
+    seg_len - defaults to radius/10, as irl_to_traffix_model
+    store, cache - ModelStore and BinaryCache to use, default ones if None
+    kwargs - Map arguments (seed is not part of the key) and the other region_to_traffix_model arguments
+    """
+    store = ModelStore() if store is None else store
+    seg_len = radius/10 if seg_len is None else seg_len
+    build_args = {name: kwargs.pop(name) for name in ('draw', 'max_nodes', 'cycle_method', 'cycle_weight', 'contract') if name in kwargs}
+    seed = kwargs.pop('seed', None)
+    key = model_key(coordinates, radius, seg_len, demand, **build_args, **kwargs)
+    model = store.load(key, seed=seed)
+    if model is None:
+        model = region_to_traffix_model(coordinates, radius, cache=cache, seg_len=seg_len, seed=seed, **build_args, **kwargs)
+        pairs = [(source, sink, cars) for source, cars_to_sinks in demand.items() for sink, cars in cars_to_sinks.items()]
+        model.set_demand({'source': [pair[0] for pair in pairs], 'sink': [pair[1] for pair in pairs], 'cars': [pair[2] for pair in pairs]})
+        model.simulation_check_compile()
+        store.save(key, model)
+    return model
@@ -3,88 +3,351 @@
 # The main function is irl_to_traffix_model
 
 from traffix import *
+import heapq
 import random
+import time
 import numpy as np
-import osmnx as ox
+try:
+    import osmnx as ox
+except ImportError:
+    # only needed to download new areas, cached responses can be loaded offline with traffixcache
+    ox = None
 import pandas as pd
 import networkx as nx
 
-def irl_to_traffix_model(coordinates, radius):
+# networks larger than this are not drawn or listed in full by default, matplotlib and the console can't keep up
+DRAW_LIMIT = 500
+
+def graph_to_tables(G):
     """
-    Takes in coordinates (x, y) or (long, lat) and a radius size, and returns a model able to be simulated with TraffiX
+    Takes an OSMNX (Multi)DiGraph and returns its nodes (osmid, x, y) and edges (u, v, length, lanes) as DataFrames.
+    Edge geometry is skipped, which is what makes this fast on large graphs.
+    """
+    nodes = pd.DataFrame([(node, data['x'], data['y']) for node, data in G.nodes(data=True)],
+                         columns=['osmid', 'x', 'y'])
+    edges = pd.DataFrame([(edge[0], edge[1], edge[-1].get('length', np.nan), edge[-1].get('lanes', np.nan),
+                           edge[-1].get('osm_edges', [edge[:-1]]))
+                          for edge in (G.edges(keys=True, data=True) if G.is_multigraph() else G.edges(data=True))],
+                         columns=['u', 'v', 'length', 'lanes', 'osm_edges'])
+    return nodes, edges
+
+def contract_chains(G):
+    """
+    Merges chains of nodes with a single in-edge and a single out-edge (shape points, bends) into single edges, in place.
+    A merged edge sums the lengths, takes the smallest lane count and lists the original edges it replaces ((u, v, key)
+    for MultiDiGraphs) in its osm_edges attribute, for visualization. Returns the number of nodes removed.
+    """
+    multi = G.is_multigraph()
+    out_edges = (lambda node: G.out_edges(node, keys=True, data=True)) if multi else (lambda node: G.out_edges(node, data=True))
+    inner = {node for node in G if G.in_degree(node) == 1 and G.out_degree(node) == 1}
+    merged = []
+    removed = set()
+    for start in G:
+        if start in inner:
+            continue
+        for edge in out_edges(start):
+            if edge[1] not in inner:
+                continue
+            chain = [edge]
+            while chain[-1][1] in inner:
+                removed.add(chain[-1][1])
+                chain.append(next(iter(out_edges(chain[-1][1]))))
+            data = dict(chain[0][-1])
+            data['length'] = sum(edge[-1].get('length', 0) for edge in chain)
+            data['lanes'] = min(_as_number(edge[-1].get('lanes')) for edge in chain)
+            data['osm_edges'] = [osm_edge for edge in chain for osm_edge in edge[-1].get('osm_edges', [edge[:-1]])]
+            merged.append((start, chain[-1][1], data))
+    # chains closing a cycle without any other node have no start and are left as they are
+    G.remove_nodes_from(removed)
+    for u, v, data in merged:
+        # a DiGraph holds one edge per pair of nodes, keep the shortest
+        if multi or not G.has_edge(u, v) or G[u][v].get('length', 0) > data['length']:
+            G.add_edge(u, v, **data)
+    return len(removed)
+
+def clean_tables(nodes, edges, round_to=50):
+    """
+    Vectorized cleaning of the node and edge tables before building a model:
+    - positions normalized to [0, 1]
+    - lengths rounded to the nearest nonzero multiple of round_to (for seg_len purposes in traffix.py), or only made
+      positive if round_to is None (for Maps with adaptive segmentation, which keep exact lengths)
+    - lanes NaN and invalid values (e.g. lists, "2;3") set to 1
+    - parallel edges collapsed to the shortest one, since a Map has at most one road per pair of intersections
+    """
+    nodes = nodes.copy()
+    for coord, pos in (('x', 'xpos'), ('y', 'ypos')):
+        span = nodes[coord].max() - nodes[coord].min()
+        nodes[pos] = (nodes[coord] - nodes[coord].min()) / (span if span > 0 else 1)
+    edges = edges.copy()
+    if round_to is None:
+        length = pd.to_numeric(edges['length'], errors='coerce').fillna(1).to_numpy()
+        edges['length'] = np.maximum(length, 1)
+    else:
+        length = pd.to_numeric(edges['length'], errors='coerce').fillna(round_to).to_numpy()
+        edges['length'] = np.maximum(np.round(length / round_to) * round_to, round_to)
+    lanes = pd.to_numeric(edges['lanes'], errors='coerce').fillna(1).to_numpy()
+    edges['lanes'] = np.maximum(lanes, 1).astype(int)
+    edges = edges.sort_values('length', kind='stable').drop_duplicates(['u', 'v']).sort_index()
+    return nodes, edges.reset_index(drop=True)
+
+def build_model(nodes, edges, seg_len, **map_kwargs):
+    """
+    Builds an uncompiled Map from cleaned node and edge tables (see clean_tables) with the bulk constructors.
+    """
+    model = Map(**{'confirmation_messages': False, 'seg_len': seg_len, **map_kwargs})
+    model.add_inters_from(nodes['osmid'], nodes[['xpos', 'ypos']].to_numpy())
+    # this is a shortcoming of the osmnx dataset. Speed limits are often not listed for road segments so we just make this assumption here.
+    # really, this model makes a lot of gross assumptions, so this comparatively isn't too gross.
+    model.add_roads_from({'start': edges['u'], 'end': edges['v'], 'speed_limit': 50,
+                          'length': edges['length'], 'lanes': edges['lanes'], 'num_cars': 0})
+    if 'osm_edges' in edges:
+        # road (start label, end label) -> the OSM edges it stands for
+        model.osm_edges = dict(zip(zip(edges['u'].tolist(), edges['v'].tolist()), edges['osm_edges']))
+    return model
+
+def print_timings(timings):
+    """
+    Prints a per-stage timing report, as stored in model.build_timings.
+    """
+    width = max(len(stage) for stage in timings)
+    print("    Timing per stage:")
+    for stage, seconds in timings.items():
+        print(f"    - {stage:<{width}}  {seconds:8.3f} s")
+    print(f"    - {'total':<{width}}  {sum(timings.values()):8.3f} s")
+
+def _as_number(value, default=1):
+    """
+    Reads a numeric OSM attribute such as lanes, which can be missing, a string ("2") or a list of them (["1", "2"]).
+    Lists give their smallest entry, anything unreadable gives default.
+    """
+    if isinstance(value, list):
+        numbers = [_as_number(item, None) for item in value]
+        numbers = [number for number in numbers if number is not None]
+        return min(numbers) if numbers else default
+    try:
+        number = float(value)
+    except (TypeError, ValueError):
+        return default
+    return default if np.isnan(number) else number
+
+def _arc_weights(G, weight):
+    """
+    Returns {u: {v: weight}} over all (non self-loop) arcs of G, with parallel edges summed.
+    Without a weight attribute every edge counts as 1.
+    """
+    arcs = {}
+    multi = G.is_multigraph()
+    for u, nbrs in G.succ.items():
+        arcs[u] = out = {}
+        for v, data in nbrs.items():
+            if v == u:
+                continue
+            edges = data.values() if multi else (data,)
+            out[v] = sum(1 if weight is None else _as_number(edge.get(weight)) for edge in edges)
+    return arcs
+
+def _dfs_back_arcs(G):
+    """
+    One iterative depth first search, returning its back arcs (including self-loops).
+    """
+    # 1 = on the stack, 2 = finished
+    state = {}
+    back_arcs = []
+    for root in G:
+        if root in state:
+            continue
+        state[root] = 1
+        stack = [(root, iter(G.succ[root]))]
+        while stack:
+            u, nbrs = stack[-1]
+            for v in nbrs:
+                seen = state.get(v)
+                if seen is None:
+                    state[v] = 1
+                    stack.append((v, iter(G.succ[v])))
+                    break
+                if seen == 1:
+                    back_arcs.append((u, v))
+            else:
+                state[u] = 2
+                stack.pop()
+    return back_arcs
+
+def _eades_back_arcs(G, weight=None):
+    """
+    Eades-Lin-Smyth ordering: peel off sinks and sources, otherwise take the node with the largest
+    (weighted out - weighted in) degree. Arcs pointing backwards in the resulting order are returned,
+    so with a weight the removed arcs are biased towards light (e.g. low lane count) ones.
+    """
+    out_arcs = _arc_weights(G, weight)
+    in_arcs = {node: {} for node in G}
+    for u, out in out_arcs.items():
+        for v, w in out.items():
+            in_arcs[v][u] = w
+    out_deg = {node: len(out_arcs[node]) for node in G}
+    in_deg = {node: len(in_arcs[node]) for node in G}
+    delta = {node: sum(out_arcs[node].values()) - sum(in_arcs[node].values()) for node in G}
+    sinks = [node for node in G if out_deg[node] == 0]
+    sources = [node for node in G if in_deg[node] == 0]
+    heap = [(-delta[node], count, node) for count, node in enumerate(G)]
+    heapq.heapify(heap)
+    counter = len(heap)
+    alive = set(G)
+    head, tail = [], []
+
+    def remove(u):
+        nonlocal counter
+        alive.discard(u)
+        for p, w in in_arcs[u].items():
+            if p in alive:
+                out_deg[p] -= 1
+                delta[p] -= w
+                if out_deg[p] == 0:
+                    sinks.append(p)
+                counter += 1
+                heapq.heappush(heap, (-delta[p], counter, p))
+        for s, w in out_arcs[u].items():
+            if s in alive:
+                in_deg[s] -= 1
+                delta[s] += w
+                if in_deg[s] == 0:
+                    sources.append(s)
+                counter += 1
+                heapq.heappush(heap, (-delta[s], counter, s))
+
+    while alive:
+        while sinks:
+            u = sinks.pop()
+            if u in alive:
+                remove(u)
+                tail.append(u)
+        while sources:
+            u = sources.pop()
+            if u in alive:
+                remove(u)
+                head.append(u)
+        while heap and alive:
+            neg_delta, _, u = heapq.heappop(heap)
+            if u in alive and -neg_delta == delta[u]:
+                remove(u)
+                head.append(u)
+                break
+    position = {node: i for i, node in enumerate(head + tail[::-1])}
+    return [(u, v) for u, nbrs in G.succ.items() for v in nbrs if position[u] >= position[v]]
+
+def break_cycles(G, method=None, weight=None):
+    """
+    Makes G acyclic in place by removing a feedback arc set found in a single pass, and returns the removed edges.
+    Works on DiGraphs and MultiDiGraphs (all parallel edges of a removed arc are removed, with their keys).
     Arguments
-    coordinates - tuple for x and y coordinates
-    radius - how large of an area you want to map
-    The maximum number of nodes it will plot is 25. It will raise an Assertion error if the inputted area
-    is too large, asking the user to reduce.
+    method - "dfs" removes the back arcs of one depth first search (fastest), "eades" uses the Eades-Lin-Smyth
+             ordering, which usually removes fewer edges. Defaults to "eades" if a weight is given, else "dfs"
+    weight - optional edge attribute (e.g. "lanes") to prefer removing low-capacity edges, only used by "eades"
     """
-    # Load in OSMNX graph
-    G_raw = ox.graph.graph_from_point(coordinates, dist=radius, network_type="drive")
+    if method is None:
+        method = "dfs" if weight is None else "eades"
+    assert method in ("dfs", "eades"), "method must be 'dfs' or 'eades'."
+    assert method == "eades" or weight is None, "Weighted cycle breaking needs method='eades'."
+    back_arcs = _dfs_back_arcs(G) if method == "dfs" else _eades_back_arcs(G, weight)
+    if G.is_multigraph():
+        removed = [(u, v, key) for u, v in back_arcs for key in G.succ[u][v]]
+    else:
+        removed = back_arcs
+    G.remove_edges_from(removed)
+    return removed
+
+def graph_to_traffix_model(G_raw, seg_len, description="IRL road network", draw=None, max_nodes=None,
+                           cycle_method=None, cycle_weight=None, contract=True, timings=None, **map_kwargs):
+    """
+    Takes an OSMNX-style (Multi)DiGraph (nodes with x and y, edges with length and lanes) and returns an uncompiled model
+    of its largest weakly connected component, after breaking its cycles (modifies G_raw).
+    Arguments
+    seg_len - seg_len of the model
+    description - what the network is, for the printed messages
+    timings - optional dict of earlier stage timings (e.g. download) to report along with the others
+    See irl_to_traffix_model for the other arguments.
+    """
+    timings = {} if timings is None else timings
+    clock = time.perf_counter()
+    def lap(stage):
+        nonlocal clock
+        now = time.perf_counter()
+        timings[stage] = now - clock
+        clock = now
     
+    assert len(G_raw) > 0, "Invalid Area. Resulting map is not weakly connected/not present."
     # Graph reduction to acyclic graph for modeling purposes, remove isolated nodes, get weakly-connected graph
-    while not nx.is_directed_acyclic_graph(G_raw):
-        edges_to_remove = list(nx.find_cycle(G_raw, orientation="original"))
-        G_raw.remove_edges_from(edges_to_remove)
+    break_cycles(G_raw, method=cycle_method, weight=cycle_weight)
+    lap('cycle breaking')
     components = list(nx.weakly_connected_components(G_raw))
     largest_component = max(components, key=len)
     G = G_raw.subgraph(largest_component).copy()
     G.remove_nodes_from(list(nx.isolates(G)))
+    lap('largest component')
+    if contract:
+        contract_chains(G)
+        lap('chain contraction')
 
     # Check for weakly-connected, directed acyclic, size of graph is feasible
     assert nx.is_weakly_connected(G), "Invalid Area. Resulting map is not weakly connected/not present."
     assert nx.is_directed_acyclic_graph(G), "Invalid Area. Modifications did not produce a DAG. Please choose a different area."
-    assert len(G.nodes) <= 25, "Please reduce the size of the requested region (lower radius, choose less dense area)."
+    assert max_nodes is None or len(G.nodes) <= max_nodes, "Please reduce the size of the requested region (lower radius, choose less dense area)."
     
-    # Get positions based on node coordinates for more accurate visualization (using geo Pandas dataframes)
-    nodes, edges = ox.graph_to_gdfs(G)
-    nodes = nodes.reset_index()
-    edges = edges.reset_index()
-    # Normalize coords
-    nodes['xpos'] = (nodes['x'] - nodes['x'].min()) / (nodes['x'].max() - nodes['x'].min())
-    nodes['ypos'] = (nodes['y'] - nodes['y'].min()) / (nodes['y'].max() - nodes['y'].min())
-    # Round edge lengths to nearest multiple of 50, nonzero (for seg_len purposes in traffix.py)
-    edges['length'] = round(edges['length'] / 50, 0) * 50
-    edges.loc[edges['length'] == 0, 'length'] = 50
-    # Fill in lane NaN and invalid values (e.g. lists) with 1
-    edges['lanes'].fillna(1, inplace=True)
-    edges['lanes'] = edges['lanes'].apply(lambda x: 1 if isinstance(x, list) else x)
-    edges['lanes'] = edges['lanes'].astype(int)
+    # Get positions based on node coordinates for more accurate visualization
+    adaptive = any(name in map_kwargs for name in ('cell_budget', 'min_cells_per_road', 'max_cells_per_road'))
+    nodes, edges = clean_tables(*graph_to_tables(G), round_to=None if adaptive else 50)
+    lap('cleaning')
     
     # Instantiation of TraffiX model
-    model = Map(confirmation_messages = False, seg_len=radius/10)
-    
-    for node_row in range(len(nodes)):
-        name = nodes.loc[node_row, 'osmid']
-        position = (nodes.loc[node_row, 'xpos'], nodes.loc[node_row, 'ypos'])
-        model.add_inter(label=name, pos=position)
-        
-    #m.add_road(1, 2, speed_limit=50, length=100, lanes=1, num_cars=0)
-    for edge_row in range(len(edges)):
-        start = edges.loc[edge_row, 'u']
-        end = edges.loc[edge_row, 'v']
-        speed_limit = 50
-        # this is a shortcoming of the osmnx dataset. Speed limits are often not listed for road segments so we just make this assumption here.
-        # really, this model makes a lot of gross assumptions, so this comparatively isn't too gross.
-        length = edges.loc[edge_row, 'length']
-        lanes = edges.loc[edge_row, 'lanes']
-        model.add_road(start, end, speed_limit=speed_limit, length=length, lanes=lanes, num_cars=0)
+    model = build_model(nodes, edges, seg_len=seg_len, **map_kwargs)
+    lap('model construction')
     
+    small = len(model.node_labels) <= DRAW_LIMIT
     print(f"""
-    Uncompiled model of IRL road network at {coordinates} with radius {radius} returned.
+    Uncompiled model of {description} returned.
+    {len(model.node_labels)} intersections, {model.G.number_of_edges()} roads.
     Please declare input nodes and initialize number of cars to sinks before compilation.
-    The current summary of the graph (with sinks) and a sketch of the graph are below.
     """)
-    model.get_summary()
-    nx.draw(model.G, pos=model.node_positions)
+    if small:
+        model.get_summary()
+    if draw if draw is not None else small:
+        nx.draw(model.G, pos=model.node_positions)
+        lap('drawing')
+    model.build_timings = timings
+    print_timings(timings)
     
     # Display root nodes for potential inputs the user can provide
     in_degrees = dict(model.G.in_degree(model.G.nodes))
-    roots = [node for node in in_degrees if in_degrees[node] == 0]
+    roots = [model.node_label(node) for node in in_degrees if in_degrees[node] == 0]
+    shown = roots if small or len(roots) <= 20 else roots[:20] + [f"... {len(roots) - 20} more"]
     print(f"""
     For reference, the root nodes that can serve as potential inputs are:
-    {roots}
+    {shown}
     Initialize inputs with:
     - .declare_inflow_node(source_node (its name), initial_cars_to_sinks (dictionary, sinks are keys, num_cars are values))
     """)
     
-    return model
\ No newline at end of file
+    return model
+
+def irl_to_traffix_model(coordinates, radius, draw=None, max_nodes=None, cycle_method=None, cycle_weight=None, contract=True, **map_kwargs):
+    """
+    Takes in coordinates (x, y) or (long, lat) and a radius size, and returns a model able to be simulated with TraffiX
+    Arguments
+    coordinates - tuple for x and y coordinates
+    radius - how large of an area you want to map
+    draw - whether to draw the resulting network, defaults to drawing only networks up to DRAW_LIMIT nodes
+    max_nodes - optional cap on the number of nodes, raises an Assertion error if the area is larger
+    cycle_method, cycle_weight - how cycles are broken, see break_cycles (e.g. cycle_weight="lanes" to cut small roads first)
+    contract - merge chains of shape points into single roads, see contract_chains (model.osm_edges maps roads back)
+    map_kwargs - passed on to Map (e.g. update_mode, seed, or cell_budget to bound the size of the simulation)
+    The time spent in each stage is printed and stored in model.build_timings.
+    Needs osmnx, see traffixcache.overpass_to_traffix_model to build models offline from its cache.
+    """
+    assert ox is not None, "irl_to_traffix_model needs osmnx. Use traffixcache.overpass_to_traffix_model to build from cached responses offline."
+    clock = time.perf_counter()
+    # Load in OSMNX graph
+    G_raw = ox.graph.graph_from_point(coordinates, dist=radius, network_type="drive")
+    timings = {'download': time.perf_counter() - clock}
+    return graph_to_traffix_model(G_raw, radius/10, f"IRL road network at {coordinates} with radius {radius}", draw=draw,
+                                  max_nodes=max_nodes, cycle_method=cycle_method, cycle_weight=cycle_weight,
+                                  contract=contract, timings=timings, **map_kwargs)
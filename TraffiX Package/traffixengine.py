@@ -0,0 +1,980 @@
+# Array-backed simulation engine for TraffiX.
+# Map.simulation_check_compile turns the NetworkX graph into a CompiledNetwork: an immutable, CSR-style snapshot with
+# integer edge ids and NumPy arrays for every quantity update_time needs. The simulator steps on these arrays instead of
+# walking the nested NetworkX dicts.
+
+import heapq
+import json
+import os
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
+
+import numpy as np
+import scipy.sparse as sp
+
+
+def _frozen(array, dtype):
+    """
+    Returns a read-only copy of array with the given dtype.
+    """
+    out = np.array(array, dtype=dtype)
+    out.flags.writeable = False
+    return out
+
+
+class CompiledNetwork:
+    """
+    Immutable array snapshot of a compiled road network.
+    The edges of the snapshot are road cells: each road of the graph is a contiguous range of cell ids, joined by
+    virtual intersections with a single out-edge, so intersections with turn probabilities only exist at real junctions.
+    """
+
+    def __init__(self, node_labels, edge_src, edge_dst, capacity, length, lanes, num_cars, turn_prob,
+                 road_offsets=None, num_nodes=None, dt=1, flow_constant=5, ideal_send_per_lane_per_green=10):
+        """
+        Parameters:
+        node_labels: the graph node labels, position i is the label of node id i.
+        edge_src, edge_dst: node ids of the start and end of each edge (cell).
+        capacity, length, lanes, num_cars: per-edge road attributes (num_cars is the initial traffic).
+        turn_prob: per-edge turn probability, i.e. the share of traffic at edge_src that turns onto the edge.
+        road_offsets: the cells of road r are the edge ids road_offsets[r]:road_offsets[r+1] (default: one road per edge).
+        num_nodes: total number of nodes, ids past len(node_labels) are virtual intersections inside roads.
+        dt, flow_constant, ideal_send_per_lane_per_green: the Map constants used by the update rule.
+
+        out_offsets, out_edges, out_prob: CSR out-edge table, the out-edges of node n are
+        out_edges[out_offsets[n]:out_offsets[n+1]], with turn probabilities out_prob at the same positions.
+        is_sink: per-node flag for nodes without out-edges.
+        """
+        self.node_labels = list(node_labels)
+        self.node_index = {label: i for i, label in enumerate(self.node_labels)}
+        self.num_nodes = len(self.node_labels) if num_nodes is None else num_nodes
+
+        self.edge_src = _frozen(edge_src, np.int64)
+        self.edge_dst = _frozen(edge_dst, np.int64)
+        self.num_edges = len(self.edge_src)
+
+        self.capacity = _frozen(capacity, np.float64)
+        self.length = _frozen(length, np.float64)
+        self.lanes = _frozen(lanes, np.float64)
+        self.num_cars = _frozen(num_cars, np.float64)
+        self.turn_prob = _frozen(turn_prob, np.float64)
+
+        if road_offsets is None:
+            road_offsets = np.arange(self.num_edges + 1)
+        self.road_offsets = _frozen(road_offsets, np.int64)
+        self.num_roads = len(self.road_offsets) - 1
+        # cells inside a road lead into a virtual intersection whose only out-edge is the next cell
+        self.interior = _frozen(self.edge_dst >= len(self.node_labels), bool)
+
+        counts = np.bincount(self.edge_src, minlength=self.num_nodes)
+        self.out_offsets = _frozen(np.concatenate(([0], np.cumsum(counts))), np.int64)
+        self.out_edges = _frozen(np.argsort(self.edge_src, kind='stable'), np.int64)
+        self.out_prob = _frozen(self.turn_prob[self.out_edges], np.float64)
+        self.is_sink = _frozen(counts == 0, bool)
+
+        # per-edge downstream tables: the positions in out_edges of the out-edges of the intersection each edge leads into
+        self.edge_out_start = _frozen(self.out_offsets[self.edge_dst], np.int64)
+        self.edge_out_stop = _frozen(self.out_offsets[self.edge_dst + 1], np.int64)
+
+        self.dt = dt
+        self.flow_constant = flow_constant
+        self.ideal_send = ideal_send_per_lane_per_green
+        self._sequential_tables = None
+        self._turn_matrix = None
+        self._level_batches = None
+        self._padded_tables = None
+
+    @classmethod
+    def from_graph(cls, G, dt=1, flow_constant=5, ideal_send_per_lane_per_green=10):
+        """
+        Builds a snapshot from a compiled Map graph, expanding every road (graph edge) into its num_segs cells.
+        Turn probabilities are read from the node attributes (G.nodes[node][edge]) written by
+        Map.simulation_check_compile, and the cars on a road (num_cars) are spread evenly over its cells.
+        Node ids follow the order of G.nodes, node labels are the 'label' node attributes (the node itself if absent).
+        """
+        node_labels = [data.get('label', node) for node, data in G.nodes(data=True)]
+        node_index = {node: i for i, node in enumerate(G.nodes)}
+        roads = list(G.edges(data=True))
+        road_src = np.array([node_index[u] for u, v, data in roads], dtype=np.int64)
+        road_dst = np.array([node_index[v] for u, v, data in roads], dtype=np.int64)
+        num_segs = np.array([data.get('num_segs', 1) for u, v, data in roads], dtype=np.int64)
+        seg_length = np.array([data.get('seg_length', data['length']) for u, v, data in roads], dtype=np.float64)
+        capacity = np.array([data['capacity'] for u, v, data in roads], dtype=np.float64)
+        lanes = np.array([data['lanes'] for u, v, data in roads], dtype=np.float64)
+        num_cars = np.array([data['num_cars'] for u, v, data in roads], dtype=np.float64)
+        turn_prob = np.array([G.nodes[u].get((u, v), 0.0) for u, v, data in roads], dtype=np.float64)
+
+        # cell c of road r is preceded by the virtual intersection num_nodes + c - r - 1 unless it is the first cell,
+        # and followed by the virtual intersection num_nodes + c - r unless it is the last cell
+        road_offsets = np.concatenate(([0], np.cumsum(num_segs)))
+        road = np.repeat(np.arange(len(roads)), num_segs)
+        cell = np.arange(road_offsets[-1])
+        first = cell == road_offsets[:-1][road]
+        last = cell == road_offsets[1:][road] - 1
+        edge_src = np.where(first, road_src[road], len(node_labels) + cell - road - 1)
+        edge_dst = np.where(last, road_dst[road], len(node_labels) + cell - road)
+
+        network = cls(node_labels, edge_src, edge_dst, capacity[road], seg_length[road], lanes[road],
+                      (num_cars / num_segs)[road], np.where(first, turn_prob[road], 1.0),
+                      road_offsets=road_offsets, num_nodes=len(node_labels) + len(cell) - len(roads),
+                      dt=dt, flow_constant=flow_constant, ideal_send_per_lane_per_green=ideal_send_per_lane_per_green)
+        network.road_labels = [(u, v) for u, v, data in roads]
+        return network
+
+    def road_totals(self, num_cars):
+        """
+        Sums per-cell values (last axis) over the cells of each road, e.g. the cars on each road.
+        """
+        if self.num_roads == 0:
+            return np.zeros(np.shape(num_cars)[:-1] + (0,))
+        return np.add.reduceat(num_cars, self.road_offsets[:-1], axis=-1)
+
+    def sequential_tables(self):
+        """
+        Returns the per-edge arrays used by step_sequential as Python lists, built once per network.
+        Element access on lists is much faster than on NumPy arrays inside the green-light loop.
+        """
+        if self._sequential_tables is None:
+            self._sequential_tables = tuple(array.tolist() for array in (
+                self.capacity, self.length, self.lanes, self.out_edges, self.out_prob,
+                self.edge_out_start, self.edge_out_stop, self.edge_dst, self.edge_src))
+        return self._sequential_tables
+
+    def turn_matrix(self):
+        """
+        Returns the sparse edge-to-edge turn probability matrix T at real junctions, built once per network.
+        T[e, o] is the share of the cars leaving edge e that turn onto edge o. Rows of edges into sinks and of cells
+        inside roads are zero, cells pass their cars to the next cell of the road (a shift) instead.
+        """
+        if self._turn_matrix is None:
+            junction = np.flatnonzero(~self.interior)
+            starts, stops = self.edge_out_start[junction], self.edge_out_stop[junction]
+            rows = np.repeat(junction, stops - starts)
+            entries = _ranges(starts, stops)
+            self._turn_matrix = sp.csr_matrix((self.out_prob[entries], (rows, self.out_edges[entries])),
+                                              shape=(self.num_edges, self.num_edges))
+        return self._turn_matrix
+
+    def level_batches(self):
+        """
+        Returns the independent edge batches used by step_batched, built once per network.
+        Each batch holds edges leading into distinct intersections of the same topological level, so no edge in a batch
+        shares a downstream intersection with, or is downstream of, another edge in the batch. Sending a whole batch at
+        once is therefore the same as sending its edges one at a time.
+        Each batch is a tuple (edges, sink_mask, out_cells, out_probs, out_starts) with the out-edges of the non-sink
+        edges and their turn probabilities flattened into out_cells and out_probs, and segment offsets out_starts.
+        """
+        if self._level_batches is None:
+            levels, node_level = _levels_by_source(self.num_nodes, self.edge_src, self.edge_dst)
+            by_dst = np.argsort(self.edge_dst, kind='stable')
+            first = np.searchsorted(self.edge_dst[by_dst], self.edge_dst[by_dst])
+            rank = np.empty(self.num_edges, dtype=np.int64)
+            rank[by_dst] = np.arange(self.num_edges) - first
+            dst_level = node_level[self.edge_dst]
+            order = np.lexsort((rank, dst_level))
+            keys = np.stack((dst_level[order], rank[order]), axis=1)
+            splits = np.flatnonzero(np.any(np.diff(keys, axis=0) != 0, axis=1)) + 1
+
+            self._level_batches = []
+            for edges in np.split(order, splits):
+                into_sink = self.is_sink[self.edge_dst[edges]]
+                movers = edges[~into_sink]
+                starts, stops = self.edge_out_start[movers], self.edge_out_stop[movers]
+                out_starts = np.concatenate(([0], np.cumsum(stops - starts)[:-1])) if len(movers) else starts
+                entries = _ranges(starts, stops)
+                self._level_batches.append((edges, into_sink, self.out_edges[entries], self.out_prob[entries], out_starts))
+        return self._level_batches
+
+    def padded_tables(self):
+        """
+        Returns the per-edge downstream tables padded to the maximum out-degree, built once per network.
+        out_pad[e] holds the out-edges of the intersection edge e leads into, padded with the sentinel id num_edges,
+        and prob_pad[e] the matching turn probabilities, padded with 0.
+        """
+        if self._padded_tables is None:
+            counts = self.edge_out_stop - self.edge_out_start
+            width = max(int(counts.max()) if self.num_edges else 0, 1)
+            slot = np.arange(width)
+            valid = slot[None, :] < counts[:, None]
+            entries = np.where(valid, self.edge_out_start[:, None] + slot[None, :], 0)
+            out_pad = np.where(valid, np.append(self.out_edges, 0)[entries], self.num_edges)
+            prob_pad = np.where(valid, np.append(self.out_prob, 0)[entries], 0.0)
+            self._padded_tables = (out_pad, prob_pad)
+        return self._padded_tables
+
+    def initial_state(self):
+        """
+        Returns a fresh SimulationState holding the initial traffic of the network.
+        """
+        return SimulationState(self.num_cars.copy(), np.zeros(self.num_nodes))
+
+
+def _ranges(starts, stops):
+    """
+    Concatenation of np.arange(start, stop) for each start, stop pair, without a Python loop.
+    """
+    counts = stops - starts
+    total = counts.sum()
+    if total == 0:
+        return np.zeros(0, dtype=np.int64)
+    shifts = np.repeat(starts - np.concatenate(([0], np.cumsum(counts)[:-1])), counts)
+    return np.arange(total) + shifts
+
+
+def _levels_by_source(num_nodes, edge_src, edge_dst):
+    """
+    Groups edge ids by the topological level (longest-path depth) of their start node.
+    Returns the list of edge id arrays, one per level, and the per-node levels.
+    """
+    order = np.argsort(edge_src, kind='stable')
+    offsets = np.concatenate(([0], np.cumsum(np.bincount(edge_src, minlength=num_nodes))))
+    in_degree = np.bincount(edge_dst, minlength=num_nodes)
+    node_level = np.zeros(num_nodes, dtype=np.int64)
+    frontier = np.flatnonzero(in_degree == 0)
+    levels = []
+    level = 0
+    while len(frontier):
+        node_level[frontier] = level
+        edges = order[_ranges(offsets[frontier], offsets[frontier + 1])]
+        if len(edges):
+            levels.append(edges)
+        in_degree = in_degree - np.bincount(edge_dst[edges], minlength=num_nodes)
+        reached = np.unique(edge_dst[edges])
+        frontier = reached[in_degree[reached] == 0]
+        level += 1
+    assert sum(len(edges) for edges in levels) == len(edge_src), "Constructed road network is not acyclic."
+    return levels, node_level
+
+
+def _length_quadrature(edge_length, levels, edge_src, edge_dst, num_nodes, step):
+    """
+    Quadrature nodes x and weights w with sum(w * exp(-x * L)) ~= 1 / L for every path length L in the network.
+    Uses 1 / L = integral of exp(-x * L) dx over x > 0, substituting x = exp(t) and applying the trapezoid rule in t.
+    """
+    # the longest path bounds every path length
+    longest = np.zeros(num_nodes)
+    for edges in levels:
+        np.maximum.at(longest, edge_dst[edges], longest[edge_src[edges]] + edge_length[edges])
+    positive = edge_length[edge_length > 0]
+    shortest = positive.min() if len(positive) else 1.0
+    t = np.arange(-np.log(max(longest.max(), shortest)) - 20, -np.log(shortest) + 4 + step, step)
+    x = np.exp(t)
+    return x, step * x
+
+
+def _scaled_add(values, scales, targets, contributions, contribution_scales):
+    """
+    values[targets] += contributions in the scaled form of the flow passes, where row v stands for
+    values[v] * exp(scales[v]) and contribution i for contributions[i] * exp(contribution_scales[i]).
+    The updated rows are rescaled to a largest entry of 1, so path sums too large (or too small) for a float
+    (e.g. the ~1e300 paths across a district grid) keep their size in the log-scale offsets instead.
+    """
+    live = contributions.any(axis=1)
+    targets, contributions, contribution_scales = targets[live], contributions[live], contribution_scales[live]
+    nodes = np.unique(targets)
+    # the common scale of each updated row, the largest of its own and those of its contributions
+    top = np.full(len(values), -np.inf)
+    top[nodes] = np.where(values[nodes].any(axis=1), scales[nodes], -np.inf)
+    np.maximum.at(top, targets, contribution_scales)
+    # empty rows have no scale yet, their factor is clipped to 1 instead of overflowing
+    values[nodes] *= np.exp(np.minimum(scales[nodes] - top[nodes], 0))[:, None]
+    np.add.at(values, targets, contributions * np.exp(contribution_scales - top[targets])[:, None])
+    scales[nodes] = top[nodes]
+    peak = values[nodes].max(axis=1)
+    values[nodes] /= peak[:, None]
+    scales[nodes] += np.log(peak)
+
+
+def _flows_by_sink(num_nodes, edge_src, edge_dst, levels, decay, weights, sources, sinks, cars):
+    """
+    Expected edge flows, one backward and one forward pass over the DAG per sink. Yields each distinct sink with the
+    flows of its pairs.
+    decay[e, j] = exp(-x_j * length_e), so a product of decays along a path is exp(-x_j * path length).
+    The path sums are kept as rows scaled to a largest entry of 1 and a log-scale offset per node (see _scaled_add).
+    """
+    for sink in np.unique(sinks):
+        pairs = sinks == sink
+        # backward pass: to_sink[v, j] * exp(to_sink_scale[v]) = sum over paths v -> sink of exp(-x_j * path length)
+        to_sink = np.zeros((num_nodes, len(weights)))
+        to_sink_scale = np.zeros(num_nodes)
+        to_sink[sink] = 1
+        for edges in reversed(levels):
+            _scaled_add(to_sink, to_sink_scale, edge_src[edges], decay[edges] * to_sink[edge_dst[edges]],
+                        to_sink_scale[edge_dst[edges]])
+        # sum over paths source -> sink of 1 / path length, the normalization of the inverse length weighting
+        # (times exp(to_sink_scale[source]))
+        inv_length_sums = to_sink[sources[pairs]] @ weights
+        reachable = inv_length_sums > 0
+        # forward pass, started from every source at once with its cars per unit of weighting
+        from_sources = np.zeros((num_nodes, len(weights)))
+        from_sources_scale = np.zeros(num_nodes)
+        starts = sources[pairs][reachable]
+        _scaled_add(from_sources, from_sources_scale, starts,
+                    np.repeat((cars[pairs][reachable] / inv_length_sums[reachable])[:, None], len(weights), axis=1),
+                    -to_sink_scale[starts])
+        for edges in levels:
+            _scaled_add(from_sources, from_sources_scale, edge_dst[edges], from_sources[edge_src[edges]] * decay[edges],
+                        from_sources_scale[edge_src[edges]])
+        flows = (from_sources[edge_src] * decay * to_sink[edge_dst]) @ weights
+        # the scales of the two passes cancel out on edges carrying cars, an edge off every path has no flow at all
+        with np.errstate(divide='ignore'):
+            flows = np.exp(np.log(flows) + from_sources_scale[edge_src] + to_sink_scale[edge_dst])
+        assert np.isfinite(flows).all(), f"Expected edge flows toward sink {sink} are not finite."
+        yield int(sink), flows
+
+
+def expected_edge_flows(num_nodes, edge_src, edge_dst, edge_length, sources, sinks, cars, step=0.5, processes=1):
+    """
+    Expected number of cars travelling each edge when the cars of each (source, sink) pair split over all paths
+    from source to sink with inverse path length weighting.
+    Equivalent to enumerating every path with nx.all_simple_edge_paths, but computed path-free with forward/backward
+    passes over the DAG in topological order, so time and memory are polynomial in the size of the network.
+
+    Parameters:
+    num_nodes: number of nodes, nodes are ids 0, ..., num_nodes - 1.
+    edge_src, edge_dst, edge_length: per-edge start node, end node and length arrays.
+    sources, sinks, cars: per-pair arrays of source node, sink node and number of cars.
+    step: quadrature step, the relative error of the path weights is ~1e-8 for the default.
+    processes: number of worker processes sharing the passes (None for the number of cores), see grouped_edge_flows.
+    Returns: array of expected cars per edge.
+    """
+    flows = np.zeros(len(edge_src))
+    # one pass pair per distinct sink, or per distinct source on the reversed graph when there are fewer sources
+    by = 'source' if len(np.unique(sources)) < len(np.unique(sinks)) else 'sink'
+    for group_flows in grouped_edge_flows(num_nodes, edge_src, edge_dst, edge_length, sources, sinks, cars, by, step,
+                                          processes).values():
+        flows += group_flows
+    return flows
+
+
+def grouped_edge_flows(num_nodes, edge_src, edge_dst, edge_length, sources, sinks, cars, by='sink', step=0.5, processes=1):
+    """
+    expected_edge_flows split by the sink (by='sink') or by the source (by='source') of the pairs.
+    The groups are independent, with processes > 1 (None for the number of cores) they are shared out over a process
+    pool, the workers reading the graph arrays from and writing their flows to shared memory (see _flows_in_pool).
+    Returns: dict from each distinct sink (or source) to the array of expected cars per edge of its pairs. The arrays
+    sum to the expected_edge_flows result, so Map can cache them and recompute only the groups an edit touches.
+    """
+    assert by in ('sink', 'source'), "by must be 'sink' or 'source'."
+    if len(sources) == 0:
+        return {}
+    edge_src = np.asarray(edge_src, dtype=np.int64)
+    edge_dst = np.asarray(edge_dst, dtype=np.int64)
+    edge_length = np.asarray(edge_length, dtype=np.float64)
+    sources = np.asarray(sources, dtype=np.int64)
+    sinks = np.asarray(sinks, dtype=np.int64)
+    cars = np.asarray(cars, dtype=np.float64)
+
+    levels, node_level = _levels_by_source(num_nodes, edge_src, edge_dst)
+    x, weights = _length_quadrature(edge_length, levels, edge_src, edge_dst, num_nodes, step)
+    decay = np.exp(-np.outer(edge_length, x))
+    if by == 'source':
+        # the sources are the sinks of the reversed graph
+        edge_src, edge_dst, sources, sinks = edge_dst, edge_src, sinks, sources
+        levels = [edges for edges in reversed(levels)]
+    processes = os.cpu_count() if processes is None else processes
+    if processes > 1 and len(np.unique(sinks)) > 1:
+        return _flows_in_pool(num_nodes, edge_src, edge_dst, levels, decay, weights, sources, sinks, cars, processes)
+    return dict(_flows_by_sink(num_nodes, edge_src, edge_dst, levels, decay, weights, sources, sinks, cars))
+
+
+def _share(arrays):
+    """
+    Copies each array into a new shared memory block. Returns the blocks and the (name, shape, dtype) specs to
+    reattach them with _attach.
+    """
+    blocks, specs = [], []
+    for array in arrays:
+        block = shared_memory.SharedMemory(create=True, size=max(array.nbytes, 1))
+        np.ndarray(array.shape, array.dtype, buffer=block.buf)[...] = array
+        blocks.append(block)
+        specs.append((block.name, array.shape, array.dtype.str))
+    return blocks, specs
+
+
+def _attach(specs):
+    """
+    Reattaches the shared memory blocks of _share specs. Returns the blocks and the arrays viewing them.
+    """
+    blocks = [shared_memory.SharedMemory(name=name) for name, shape, dtype in specs]
+    arrays = [np.ndarray(shape, dtype, buffer=block.buf) for block, (name, shape, dtype) in zip(blocks, specs)]
+    return blocks, arrays
+
+
+def _flows_worker(num_nodes, specs, rows, sources, sinks, cars):
+    """
+    Pool task of _flows_in_pool: the flows of the pairs of a share of the sinks, written to their rows of the shared
+    output array.
+    """
+    blocks, (edge_src, edge_dst, level_edges, level_offsets, decay, weights, out) = _attach(specs)
+    try:
+        levels = np.split(level_edges, level_offsets[1:-1])
+        for sink, flows in _flows_by_sink(num_nodes, edge_src, edge_dst, levels, decay, weights, sources, sinks, cars):
+            out[rows[sink]] = flows
+    finally:
+        del edge_src, edge_dst, level_edges, level_offsets, decay, weights, out, levels
+        for block in blocks:
+            block.close()
+
+
+def _flows_in_pool(num_nodes, edge_src, edge_dst, levels, decay, weights, sources, sinks, cars, processes):
+    """
+    _flows_by_sink with the sinks dealt out over a pool of processes. The read-only graph arrays (edges, levels, decays
+    and quadrature weights) are copied once into shared memory instead of being sent to every task, and each worker
+    writes the flows of its sinks to their row of a shared output array, returned as a dict of rows by sink.
+    """
+    unique_sinks = np.unique(sinks)
+    rows = {int(sink): row for row, sink in enumerate(unique_sinks.tolist())}
+    level_offsets = np.concatenate(([0], np.cumsum([len(edges) for edges in levels]))).astype(np.int64)
+    level_edges = np.concatenate(levels) if levels else np.zeros(0, dtype=np.int64)
+    out = np.zeros((len(unique_sinks), len(edge_src)))
+    blocks, specs = _share([edge_src, edge_dst, level_edges, level_offsets, decay, weights, out])
+    try:
+        processes = min(processes, len(unique_sinks))
+        with ProcessPoolExecutor(max_workers=processes) as pool:
+            futures = []
+            for share in range(processes):
+                # deal the sinks out in turn, so every worker gets a mix of large and small ones
+                chosen = np.isin(sinks, unique_sinks[share::processes])
+                futures.append(pool.submit(_flows_worker, num_nodes, specs, rows,
+                                           sources[chosen], sinks[chosen], cars[chosen]))
+            for future in futures:
+                future.result()
+        out = np.array(np.ndarray(out.shape, out.dtype, buffer=blocks[-1].buf))
+    finally:
+        for block in blocks:
+            block.close()
+            block.unlink()
+    return {sink: out[row] for sink, row in rows.items()}
+
+
+class SimulationState:
+    """
+    Mutable traffic state stepped by the engine: cars on each edge and cars terminated at each node.
+    """
+
+    def __init__(self, num_cars, terminations):
+        self.num_cars = num_cars
+        self.terminations = terminations
+        self.time = 0
+
+
+def step_sequential(network, state, order):
+    """
+    Moves state forward one time-step, giving each edge a green light in the given order (a permutation of edge ids).
+    Each send updates the state right away, exactly like the original Map.update_time.
+    The per-edge downstream tables are built once per network, so a step is linear in the number of edges.
+    """
+    capacity, length, lanes, out_edges, out_prob, out_start, out_stop, edge_dst, edge_src = network.sequential_tables()
+    num_cars = state.num_cars.tolist()
+    terminations = state.terminations
+    speed = network.dt * network.flow_constant
+    ideal_send = network.ideal_send
+    inf = float('inf')
+
+    for edge in order.tolist() if isinstance(order, np.ndarray) else order:
+        lo = out_start[edge]
+        hi = out_stop[edge]
+        cars = num_cars[edge]
+
+        if lo == hi: # edge leads to a sink
+            speed_factor = max(capacity[edge] - cars, 0) / capacity[edge] + 0.2
+            to_send_num = min(ideal_send * lanes[edge] * speed_factor, cars)
+            terminations[edge_dst[edge]] += to_send_num
+            num_cars[edge] = cars - to_send_num
+            continue
+
+        # the max possible that can be sent without overflow, then take into account speed
+        out_flux_cap = inf
+        for entry in range(lo, hi):
+            prob = out_prob[entry]
+            if prob != 0:
+                out_edge = out_edges[entry]
+                out_flux_cap = min(out_flux_cap, (capacity[out_edge] - num_cars[out_edge]) / prob)
+        max_out_flux = min(out_flux_cap, cars * speed / length[edge])
+        to_send_num = min(max_out_flux, cars)
+
+        for entry in range(lo, hi):
+            num_send = out_prob[entry] * to_send_num
+            cars -= num_send
+            num_cars[out_edges[entry]] += num_send
+        num_cars[edge] = cars
+
+    state.num_cars[:] = num_cars
+    state.time += 1
+
+
+class InflowSchedule:
+    """
+    Time-dependent demand: the cars entering the network on inflow edges, added to a state at the start of every
+    time-step with one vectorized add. Array schedules give a rate (cars per unit of time) per bin of time-steps, and
+    are expanded to a (time-steps x edges) table of cars once. Streams (iterators, e.g. generators, for very long
+    horizons) give a rate per time-step and are consumed as time moves forward.
+    """
+
+    def __init__(self, edges, rates, bin_steps, streams=(), dt=1):
+        """
+        Parameters:
+        edges, rates, bin_steps: the inflow edge (cell) id, the array of rates per bin and the time-steps per bin of each
+        array schedule.
+        streams: (edge id, iterator of rates) of each stream schedule.
+        dt: the length of a time-step, an edge receives rate * dt cars per step.
+
+        step_cars: (time-steps x len(edges)) table of the cars the array schedules add at each time-step.
+        """
+        self.edges = np.asarray(edges, dtype=np.int64)
+        horizon = max([len(rate) * steps for rate, steps in zip(rates, bin_steps)], default=0)
+        self.step_cars = np.zeros((horizon, len(self.edges)))
+        for k, (rate, steps) in enumerate(zip(rates, bin_steps)):
+            self.step_cars[:len(rate) * steps, k] = np.repeat(np.asarray(rate, dtype=np.float64), steps) * dt
+        self.stream_edges = np.array([edge for edge, stream in streams], dtype=np.int64)
+        self.streams = [stream for edge, stream in streams]
+        self.stream_cars = np.zeros(len(self.streams))
+        self.stream_done = np.zeros(len(self.streams), dtype=bool)
+        self.stream_time = 0
+        self.dt = dt
+
+    def _advance_streams(self, time):
+        """
+        Draws the stream rates of time-step time (and of the steps skipped before it). The rates of the last time-step
+        drawn are kept, so injecting that time-step again adds the same cars. Streams belong to the one state stepped
+        with this schedule: Map.ensemble rejects them, since an iterator cannot be replayed for other replicas.
+        """
+        assert time >= self.stream_time - 1, "Stream schedules only move forward, declare new iterators to rerun from an earlier time."
+        while self.stream_time <= time:
+            for k, stream in enumerate(self.streams):
+                rate = None if self.stream_done[k] else next(stream, None)
+                self.stream_done[k] |= rate is None
+                self.stream_cars[k] = 0 if rate is None else rate * self.dt
+            self.stream_time += 1
+
+    def inject(self, num_cars, time):
+        """
+        Adds the cars entering at time-step time to num_cars (per-edge array, or (replicas x edges) array).
+        Returns the edges that received cars.
+        """
+        added = []
+        if time < len(self.step_cars):
+            num_cars[..., self.edges] += self.step_cars[time]
+            added.append(self.edges[self.step_cars[time] > 0])
+        if self.streams:
+            self._advance_streams(time)
+            num_cars[..., self.stream_edges] += self.stream_cars
+            added.append(self.stream_edges[self.stream_cars > 0])
+        return np.concatenate(added).tolist() if added else []
+
+    def finished(self, time):
+        """
+        Whether no more cars enter from time-step time on (streams only finish once exhausted).
+        """
+        return time >= len(self.step_cars) and bool(self.stream_done.all())
+
+
+class ActiveSet:
+    """
+    The edges step_active gives green lights to: edges with more than eps cars whose downstream intersection has room.
+    Edges with cars but a saturated downstream intersection are parked by intersection, and woken up when a car
+    leaves one of its out-edges. Both are updated incrementally as sends happen.
+    """
+
+    def __init__(self, network, state, eps=1e-9):
+        self.network = network
+        self.eps = eps
+        self.refresh(state)
+
+    def refresh(self, state):
+        """
+        Rebuilds the active set from scratch, e.g. after editing state.num_cars directly.
+        """
+        self.active = set(np.flatnonzero(state.num_cars > self.eps).tolist())
+        self.blocked = {}
+
+    def touch(self, edges):
+        """
+        Marks edges that received cars from outside the engine as active.
+        """
+        self.active.update(edges)
+
+
+def step_active(network, state, active_set, rng=None, order=None):
+    """
+    Moves state forward one time-step with the sequential update rule, but only gives green lights to the edges in
+    active_set, so the cost of a step is proportional to the number of active edges rather than all edges.
+    Each active edge gets an i.i.d. uniform priority key drawn from rng (a NumPy Generator) and green lights go in
+    increasing key order, which is a uniformly random order as in step_sequential. An edge that becomes active during
+    the step draws a fresh key, and still gets its green light this step if the key comes after the current one (in
+    step_sequential it is equally likely to come after, and it had no cars before), so the dynamics match
+    step_sequential in distribution. Saturated edges wait instead of sending a negative flux.
+    order replays a green light order (e.g. a recorded return value) instead of drawing keys.
+    Returns: the edges in the order they got green lights.
+    """
+    capacity, length, lanes, out_edges, out_prob, out_start, out_stop, edge_dst, edge_src = network.sequential_tables()
+    num_cars = state.num_cars
+    terminations = state.terminations
+    speed = network.dt * network.flow_constant
+    ideal_send = network.ideal_send
+    eps = active_set.eps
+    active = active_set.active
+    blocked = active_set.blocked
+    inf = float('inf')
+    key = 0.0
+    heap = []
+    if order is None:
+        rng = np.random.default_rng() if rng is None else rng
+        decided = set(active)
+        heap = list(zip(rng.random(len(decided)).tolist(), sorted(decided)))
+        heapq.heapify(heap)
+
+    def wake(edge):
+        # an edge without a key this step draws one, it only gets a green light if the key comes later
+        active.add(edge)
+        if order is None and edge not in decided:
+            decided.add(edge)
+            fresh = rng.random()
+            if fresh > key:
+                heapq.heappush(heap, (fresh, edge))
+
+    def green_lights():
+        nonlocal key
+        if order is not None:
+            yield from order
+        while heap:
+            key, edge = heapq.heappop(heap)
+            yield edge
+
+    done = []
+    for edge in green_lights():
+        done.append(edge)
+        cars = float(num_cars[edge])
+        if cars <= eps:
+            active.discard(edge)
+            continue
+        lo = out_start[edge]
+        hi = out_stop[edge]
+
+        if lo == hi: # edge leads to a sink
+            speed_factor = max(capacity[edge] - cars, 0) / capacity[edge] + 0.2
+            to_send_num = min(ideal_send * lanes[edge] * speed_factor, cars)
+            terminations[edge_dst[edge]] += to_send_num
+            cars -= to_send_num
+        else:
+            # the max possible that can be sent without overflow, then take into account speed
+            out_flux_cap = inf
+            for entry in range(lo, hi):
+                prob = out_prob[entry]
+                if prob != 0:
+                    out_edge = out_edges[entry]
+                    out_flux_cap = min(out_flux_cap, (capacity[out_edge] - num_cars[out_edge]) / prob)
+            if out_flux_cap <= 0: # saturated, wait for room downstream
+                active.discard(edge)
+                blocked.setdefault(edge_dst[edge], set()).add(edge)
+                continue
+            max_out_flux = min(out_flux_cap, cars * speed / length[edge])
+            to_send_num = min(max_out_flux, cars)
+
+            for entry in range(lo, hi):
+                num_send = out_prob[entry] * to_send_num
+                if num_send > 0:
+                    out_edge = out_edges[entry]
+                    cars -= num_send
+                    num_cars[out_edge] += num_send
+                    wake(out_edge)
+
+        num_cars[edge] = cars
+        if cars <= eps:
+            active.discard(edge)
+        # room was freed at the start of this edge, wake up the edges waiting on it
+        waiting = blocked.pop(edge_src[edge], None)
+        if waiting:
+            for waiting_edge in waiting:
+                wake(waiting_edge)
+
+    state.time += 1
+    return done
+
+
+def step_synchronous(network, state):
+    """
+    Moves state forward one time-step with the synchronous ("Jacobi") update rule: every edge computes its send from the
+    same snapshot of the state, and all sends are applied at once, through the sparse turn matrix at junctions and as
+    a shift along the cells of each road.
+    Downstream edges that would be pushed over capacity by several upstream edges at once accept a proportional share
+    of each send, the rest stays on the upstream edges.
+    """
+    num_cars = state.num_cars
+    turns = network.turn_matrix()
+    interior = network.interior
+    room = network.capacity - num_cars
+    into_sink = network.is_sink[network.edge_dst]
+
+    # the max possible each intersection can pass on without overflow: min over out-edges of room / turn probability
+    with np.errstate(divide='ignore', invalid='ignore'):
+        entry_flux = np.where(network.out_prob > 0, room[network.out_edges] / network.out_prob, np.inf)
+    node_flux_cap = np.full(network.num_nodes, np.inf)
+    has_out = ~network.is_sink
+    if network.num_edges:
+        node_flux_cap[has_out] = np.minimum.reduceat(entry_flux, network.out_offsets[:-1][has_out])
+
+    # take into account speed, or remaining cars in road; edges into sinks use the speed factor
+    speed = network.dt * network.flow_constant
+    send = np.minimum(np.minimum(node_flux_cap[network.edge_dst], num_cars * speed / network.length), num_cars)
+    speed_factor = np.maximum(room, 0) / network.capacity + 0.2
+    sink_send = np.minimum(network.ideal_send * network.lanes * speed_factor, num_cars)
+    send = np.clip(np.where(into_sink, sink_send, send), 0, None)
+
+    # combined inflow of each edge: turns at junctions, shift to the next cell inside roads
+    inflow = turns.T @ np.where(into_sink | interior, 0, send)
+    inflow[1:] += np.where(interior[:-1], send[:-1], 0)
+
+    # clip the combined inflow of each edge to its room
+    free = np.maximum(room, 0)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        accepted_share = np.where(inflow > free, free / inflow, 1.0)
+    downstream_share = turns @ accepted_share
+    downstream_share[:-1] = np.where(interior[:-1], accepted_share[1:], downstream_share[:-1])
+    sent = np.where(into_sink, send, send * downstream_share)
+
+    num_cars -= sent
+    num_cars += inflow * accepted_share
+    state.terminations += np.bincount(network.edge_dst[into_sink], weights=sent[into_sink], minlength=network.num_nodes)
+    state.time += 1
+
+
+def step_batched(network, state, order):
+    """
+    Moves state forward one time-step, giving each independent batch of edges (see CompiledNetwork.level_batches) a
+    green light in the given order (a permutation of batch ids). Each batch is sent as one vectorized operation and
+    updates the state right away, so the result is the same as step_sequential with the edges of the batches in
+    that order.
+    """
+    num_cars = state.num_cars
+    capacity = network.capacity
+    speed = network.dt * network.flow_constant
+    batches = network.level_batches()
+
+    for batch in order:
+        edges, into_sink, out_cells, probs, out_starts = batches[batch]
+
+        # edges lead to sinks
+        sinking = edges[into_sink]
+        if len(sinking):
+            cars = num_cars[sinking]
+            speed_factor = np.maximum(capacity[sinking] - cars, 0) / capacity[sinking] + 0.2
+            to_send_num = np.minimum(network.ideal_send * network.lanes[sinking] * speed_factor, cars)
+            state.terminations[network.edge_dst[sinking]] += to_send_num
+            num_cars[sinking] -= to_send_num
+
+        # the max possible that can be sent without overflow, then take into account speed
+        movers = edges[~into_sink]
+        if len(movers):
+            cars = num_cars[movers]
+            with np.errstate(divide='ignore', invalid='ignore'):
+                entry_flux = np.where(probs != 0, (capacity[out_cells] - num_cars[out_cells]) / probs, np.inf)
+            out_flux_cap = np.minimum.reduceat(entry_flux, out_starts)
+            max_out_flux = np.minimum(out_flux_cap, cars * speed / network.length[movers])
+            to_send_num = np.minimum(max_out_flux, cars)
+
+            num_send = probs * np.repeat(to_send_num, np.diff(np.append(out_starts, len(out_cells))))
+            num_cars[movers] -= np.add.reduceat(num_send, out_starts)
+            num_cars[out_cells] += num_send
+
+    state.time += 1
+
+
+class Ensemble:
+    """
+    Monte Carlo ensemble of replicas of a compiled network, stepped together with the sequential update rule.
+    Each replica draws its own green light order every step, and the state is held as (replicas x edges) arrays so one
+    step costs one vectorized pass over the green light positions instead of one Python loop per replica.
+    """
+
+    def __init__(self, network, replicas=100, seed=None, schedule=None):
+        """
+        Parameters:
+        network: the CompiledNetwork to simulate.
+        replicas: number of replicas R.
+        seed: seed of the replica Generators. Replica r owns the NumPy Generator seeded with replica_seeds[r], spawned
+        from seed, and draws its green light orders from it like a sequential Map with the same seed.
+        schedule: InflowSchedule of the cars entering every replica at each time-step, None for none.
+
+        num_cars: (R x edges) array of cars on each edge, for each replica.
+        terminations: (R x nodes) array of cars terminated at each node, for each replica.
+        """
+        self.network = network
+        self.replicas = replicas
+        self.replica_seeds = np.random.SeedSequence(seed).spawn(replicas)
+        self.rngs = [np.random.default_rng(replica_seed) for replica_seed in self.replica_seeds]
+        # an extra sentinel edge with infinite room absorbs the padding of the downstream tables
+        self._num_cars = np.zeros((replicas, network.num_edges + 1))
+        self._num_cars[:, :-1] = network.num_cars
+        self.num_cars = self._num_cars[:, :-1]
+        self.terminations = np.zeros((replicas, network.num_nodes))
+        self.schedule = schedule
+        self.time = 0
+
+        # downstream tables of each edge, padded so that padding and zero probability out-edges get an infinite
+        # entry flux: (capacity - cars) * inverse probability is inf where the probability is 0. The tables are
+        # transposed to (width x edges), so a step works on (width x R) blocks reduced over their short first axis
+        out_pad, prob_pad = network.padded_tables()
+        self._out_pad = np.ascontiguousarray(out_pad.T)
+        self._prob_pad = np.ascontiguousarray(prob_pad.T)
+        self._capacity_pad = np.where(self._prob_pad != 0, np.append(network.capacity, np.inf)[self._out_pad], np.inf)
+        with np.errstate(divide='ignore'):
+            self._inv_prob_pad = np.where(self._prob_pad != 0, 1 / self._prob_pad, 1.0)
+        self._into_sink = network.is_sink[network.edge_dst]
+        self._speed_per_length = network.dt * network.flow_constant / network.length
+        self._ideal_send = network.ideal_send * network.lanes
+        # the replicas' rows of the flattened (R x edges + 1) and (R x nodes) arrays
+        self._row_cars = np.arange(replicas) * (network.num_edges + 1)
+        self._row_nodes = np.arange(replicas) * network.num_nodes
+        self._keys = np.empty((replicas, network.num_edges))
+
+    def green_light_orders(self):
+        """
+        Draws the green light order of every replica for one time-step, as an (R x edges) array. Replica r fills row r
+        with uniform keys from its own Generator (as Map.next_green_lights does) and the rows are argsorted at once.
+        """
+        for rng, keys in zip(self.rngs, self._keys):
+            rng.random(out=keys)
+        return np.argsort(self._keys, axis=1)
+
+    def step(self):
+        """
+        Moves every replica forward one time-step, each with its own random green light order.
+        """
+        network = self.network
+        if self.schedule is not None:
+            self.schedule.inject(self.num_cars, self.time)
+        capacity = network.capacity
+        num_cars = self._num_cars.reshape(-1)
+        terminations = self.terminations.reshape(-1)
+        row_cars = self._row_cars
+        row_outs = row_cars[None, :]
+
+        for edges in self.green_light_orders().T:
+            cells = row_cars + edges
+            cars = num_cars[cells]
+            sinking = self._into_sink[edges]
+
+            # edges leading to sinks
+            speed_factor = np.maximum(capacity[edges] - cars, 0) / capacity[edges] + 0.2
+            sink_send = np.minimum(self._ideal_send[edges] * speed_factor, cars)
+
+            # the max possible that can be sent without overflow, then take into account speed
+            outs = row_outs + self._out_pad[:, edges]
+            probs = self._prob_pad[:, edges]
+            entry_flux = (self._capacity_pad[:, edges] - num_cars[outs]) * self._inv_prob_pad[:, edges]
+            max_out_flux = np.minimum(entry_flux.min(axis=0), cars * self._speed_per_length[edges])
+            to_send_num = np.where(sinking, sink_send, np.minimum(max_out_flux, cars))
+
+            num_send = probs * to_send_num
+            num_cars[outs] += num_send
+            num_cars[cells] -= np.where(sinking, to_send_num, num_send.sum(axis=0))
+            terminations[self._row_nodes + network.edge_dst[edges]] += np.where(sinking, to_send_num, 0)
+
+        self.time += 1
+
+    def run(self, steps):
+        """
+        Moves every replica forward the given number of time-steps.
+        """
+        for _ in range(steps):
+            self.step()
+
+    def run_until_drained(self, tol=1e-3, max_steps=10000):
+        """
+        Steps every replica until the cars remaining on the roads of each replica fall below tol (and the schedule has
+        finished), or for at most max_steps time-steps. Returns the per-replica number of episodes until drained (NaN if
+        not drained).
+        """
+        episodes = np.full(self.replicas, np.nan)
+        steps = 0
+        while steps < max_steps:
+            pending = self.schedule is not None and not self.schedule.finished(self.time)
+            drained = np.isnan(episodes) & (self.num_cars.sum(axis=1) < tol) & (not pending)
+            episodes[drained] = steps
+            if not np.isnan(episodes).any():
+                break
+            self.step()
+            steps += 1
+        pending = self.schedule is not None and not self.schedule.finished(self.time)
+        episodes[np.isnan(episodes) & (self.num_cars.sum(axis=1) < tol) & (not pending)] = steps
+        return episodes
+
+    def statistics(self):
+        """
+        Returns the mean and variance over replicas of the cars on each road (arrays indexed by road id, i.e. by
+        network.road_labels) and of the cars terminated at each sink (dicts keyed by sink label).
+        """
+        sinks = np.flatnonzero(self.network.is_sink)
+        labels = [self.network.node_labels[sink] for sink in sinks]
+        terminations = self.terminations[:, sinks]
+        num_cars = self.network.road_totals(self.num_cars)
+        return {'num_cars_mean': num_cars.mean(axis=0),
+                'num_cars_var': num_cars.var(axis=0),
+                'terminations_mean': dict(zip(labels, terminations.mean(axis=0))),
+                'terminations_var': dict(zip(labels, terminations.var(axis=0)))}
+
+
+# single-file array container used to store compiled models: a magic string, the length of a JSON header, the header,
+# then the raw arrays, each starting on an _ALIGN byte boundary so they can be memory-mapped in place
+_MAGIC = b"TRAFFIX\x01"
+_ALIGN = 64
+
+
+def _aligned(size):
+    return -(-size // _ALIGN) * _ALIGN
+
+
+def _json_default(value):
+    if isinstance(value, np.generic):
+        return value.item()
+    raise TypeError(f"{type(value).__name__} is not JSON serializable")
+
+
+def save_arrays(path, header, arrays):
+    """
+    Writes a JSON-serializable header and a dict of numeric arrays to a single binary file (see load_arrays).
+    The file is written next to path and moved into place, so readers never see a partial file.
+    """
+    arrays = {name: np.ascontiguousarray(array) for name, array in arrays.items()}
+    layout = {}
+    offset = 0
+    for name, array in arrays.items():
+        layout[name] = {'dtype': array.dtype.str, 'shape': list(array.shape), 'offset': offset}
+        offset += _aligned(array.nbytes)
+    meta = json.dumps({'header': header, 'arrays': layout}, default=_json_default).encode("utf-8")
+    start = _aligned(len(_MAGIC) + 8 + len(meta))
+    tmp = f"{path}.{os.getpid()}.tmp"
+    with open(tmp, "wb") as file:
+        file.write(_MAGIC)
+        file.write(np.uint64(len(meta)).tobytes())
+        file.write(meta)
+        for name, array in arrays.items():
+            file.seek(start + layout[name]['offset'])
+            file.write(array.tobytes())
+        file.truncate(start + offset)
+    os.replace(tmp, path)
+
+
+def load_arrays(path, mmap=True):
+    """
+    Reads a file written by save_arrays, returns (header, arrays). With mmap, the arrays are read-only memory-maps of
+    the file, so opening is independent of its size.
+    """
+    with open(path, "rb") as file:
+        assert file.read(len(_MAGIC)) == _MAGIC, f"{path} is not a TraffiX array file."
+        size = int(np.frombuffer(file.read(8), dtype=np.uint64)[0])
+        meta = json.loads(file.read(size).decode("utf-8"))
+    start = _aligned(len(_MAGIC) + 8 + size)
+    arrays = {}
+    for name, spec in meta['arrays'].items():
+        dtype = np.dtype(spec['dtype'])
+        shape = tuple(spec['shape'])
+        if dtype.itemsize * int(np.prod(shape)) == 0:
+            arrays[name] = np.empty(shape, dtype=dtype)
+        elif mmap:
+            arrays[name] = np.memmap(path, dtype=dtype, mode='r', offset=start + spec['offset'], shape=shape)
+        else:
+            arrays[name] = np.fromfile(path, dtype=dtype, count=int(np.prod(shape)), offset=start + spec['offset']).reshape(shape)
+    return meta['header'], arrays
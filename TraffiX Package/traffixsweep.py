@@ -0,0 +1,120 @@
+# Parameter sweeps over TraffiX models.
+# A sweep takes a model factory (e.g. playkit.template_bridge) and a grid of parameter values, builds, compiles and
+# drains each model in worker processes, and returns a tidy results table. Finished points are written to an on-disk
+# result store, so an interrupted sweep picks up where it left off.
+
+import hashlib
+import itertools
+import json
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import pandas as pd
+from tqdm import tqdm
+
+
+def grid_points(param_grid):
+    """
+    Expands a parameter grid into a list of parameter dicts.
+    param_grid is either a dict of parameter name -> list of values (all combinations are used),
+    or a list of parameter dicts (used as is).
+    """
+    if isinstance(param_grid, dict):
+        names = list(param_grid)
+        return [dict(zip(names, values)) for values in itertools.product(*(param_grid[name] for name in names))]
+    return [dict(params) for params in param_grid]
+
+
+def point_key(model_factory, params, tol=1e-3, max_steps=10000, seed=None):
+    """
+    Key of a sweep point in the result store: a hash of the factory name, the parameters and the run_point settings
+    (tol, max_steps, seed), so changing any of them recomputes the point.
+    """
+    name = f"{model_factory.__module__}.{model_factory.__qualname__}"
+    text = json.dumps({'factory': name, 'params': params, 'tol': tol, 'max_steps': max_steps, 'seed': seed},
+                      sort_keys=True, default=str)
+    return hashlib.sha1(text.encode()).hexdigest()
+
+
+def run_point(model_factory, params, tol=1e-3, max_steps=10000, seed=None):
+    """
+    Builds and compiles one model with model_factory(**params) and runs it until drained.
+    Returns a flat dict of the parameters and results.
+    """
+    start = time.perf_counter()
+    m = model_factory(**params)
+    if seed is not None:
+        m.reseed(seed)
+    built = time.perf_counter()
+    episodes, arrival_times = m.run_until_drained(tol=tol, max_steps=max_steps)
+    finished = time.perf_counter()
+
+    result = dict(params)
+    result['episodes'] = episodes
+    result['drained'] = episodes is not None
+    for sink, arrival_time in arrival_times.items():
+        result[f"arrival_{sink}"] = arrival_time
+    result['build_seconds'] = built - start
+    result['run_seconds'] = finished - built
+    return result
+
+
+def _store_path(store, key):
+    return os.path.join(store, key + ".json")
+
+
+def _load_result(store, key):
+    if store is None:
+        return None
+    path = _store_path(store, key)
+    if not os.path.exists(path):
+        return None
+    with open(path) as f:
+        return json.load(f)
+
+
+def _save_result(store, key, result):
+    # write then rename, so an interrupted sweep never leaves a half-written point behind
+    path = _store_path(store, key)
+    with open(path + ".tmp", "w") as f:
+        json.dump(result, f, default=float)
+    os.replace(path + ".tmp", path)
+
+
+def sweep(model_factory, param_grid, store=None, processes=None, tol=1e-3, max_steps=10000, seed=None):
+    """
+    Runs model_factory(**params) to drain for every point of param_grid across a process pool.
+
+    Parameters:
+    model_factory: module-level function returning a compiled Map, e.g. playkit.template_bridge. Map parameters such
+    as capacity_per_length_per_lane, flow_constant or seg_len are passed through to it.
+    param_grid: dict of parameter name -> list of values (all combinations), or list of parameter dicts.
+    store: directory of the on-disk result store. Points already in the store are not recomputed.
+    processes: number of worker processes (defaults to the number of cores).
+    tol, max_steps: passed to Map.run_until_drained.
+    seed: seed of the Map Generator drawing the green light orders, the same for every point (a 'seed' entry in
+    param_grid is passed to the factory instead, to sweep over seeds).
+    Returns: pandas DataFrame with one row per point (parameters, episodes, drained, arrival_<sink> times, timings).
+    """
+    points = grid_points(param_grid)
+    keys = [point_key(model_factory, params, tol, max_steps, seed) for params in points]
+    if store is not None:
+        os.makedirs(store, exist_ok=True)
+
+    results = {key: _load_result(store, key) for key in keys}
+    todo = [(key, params) for key, params in zip(keys, points) if results[key] is None]
+    progress_bar = tqdm(total=len(todo), position=0, leave=True)
+
+    if todo:
+        with ProcessPoolExecutor(max_workers=processes) as pool:
+            futures = {pool.submit(run_point, model_factory, params, tol, max_steps, seed): key for key, params in todo}
+            for future in as_completed(futures):
+                key = futures[future]
+                results[key] = future.result()
+                if store is not None:
+                    _save_result(store, key, results[key])
+                progress_bar.update(1)
+    progress_bar.close()
+
+    return pd.DataFrame([results[key] for key in keys])
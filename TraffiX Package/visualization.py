@@ -26,8 +26,8 @@ def simulate(m, frames=150):
         # Update traffic by one time step
         m.update_time()
 
-        # Update edge_colors
-        num_cars = nx.get_edge_attributes(m.G, 'num_cars')
+        # Update edge_colors, by the average number of cars per road segment
+        num_cars = {(u, v): data['num_cars'] / data.get('num_segs', 1) for u, v, data in m.G.edges(data=True)}
         # Convert weights to a list and normalize them for color mapping
         num_cars_values = list(num_cars.values())
         norm = plt.Normalize(0, 10)  # Normalize to [0,25]
@@ -44,9 +44,9 @@ def simulate(m, frames=150):
                 edge_color=edge_colors, width=edge_widths)
 
         # Create labels for terminations, num_cars
-        shift_down_pos = {node: (x, y - 0.05) for node, (x, y) in m.node_positions.items()}
+        shift_down_pos = {node: (x, y - 0.05) for node, (x, y) in enumerate(m.node_positions)}
 
-        terminations = {sink_node: "Terms:\n" + str(round(m.G.nodes[sink_node]["terminations"],2)) for sink_node in m.sinks}
+        terminations = {sink_node: "Terms:\n" + str(round(m.G.nodes[sink_node]["terminations"],2)) for sink_node in m.sink_ids}
         nx.draw_networkx_labels(m.G, shift_down_pos, ax=ax, labels=terminations, font_size=15, font_color="black")
 
         road_num_cars = {edge: "" + str(round(m.G[edge[0]][edge[1]]["num_cars"],2)) for edge in m.G.edges}